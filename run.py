@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
 import boto3
+import botocore.config
 import argparse
+import collections
+import concurrent.futures
+import io
 import sys
 import os
 import hashlib
@@ -11,6 +15,7 @@ import zipfile
 import gzip
 import time
 import shutil
+import tempfile
 import itertools
 import dateutil.relativedelta
 from datetime import datetime
@@ -84,6 +89,20 @@ def parse_args():
         metavar=("PROFILE", "BUCKET", "PREFIX"),
         default=[],
     )
+    parser.add_argument(
+        "--download-workers",
+        help="Number of billing files to download concurrently.",
+        dest="download_workers",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--size-flexible-matching",
+        help="Let regional Linux reserved instances cover instances of any size in their family.",
+        dest="size_flexible_matching",
+        action="store_true",
+        default=False,
+    )
     parser.add_argument(
         "--ec2",
         help="Get EC2 data for PROFILE.",
@@ -104,35 +123,37 @@ def try_mkdir(path):
 
 try_mkdir("in")
 try_mkdir("in/usagecost")
+try_mkdir("in/persistent")
+try_mkdir("in/persistent/usagecost")
+try_mkdir("in/persistent/pricing")
+try_mkdir("in/persistent/offerings")
 try_mkdir("out")
 try_mkdir("out/reservation-usage")
 try_mkdir("out/instance-reservation-usage")
 try_mkdir("out/instance-size-recommendation")
 try_mkdir("out/instance-metadata")
+try_mkdir("out/instance-inventory")
 try_mkdir("out/last-month")
 try_mkdir("out/s3")
 
 default_region = "us-east-1"
+persistent_usagecost_dir = "in/persistent/usagecost"
+download_attempts = 5
+download_backoff = 1.0
+download_part_size = 16 * 1024 * 1024
+download_parts_ahead = 4
+download_multipart_threshold = 64 * 1024 * 1024
 
 def awsenv(profile, region):
     return "util/awsenv --profile {} --region {}".format(profile, region)
 
 
-def build_billing_diff():
-    os.system("src/get_bill_diff.py")
-
+def build_usagecost_cache():
+    os.system("src/build_usagecost_cache.py")
 
-def build_instance_history():
-    os.system("src/get_ec2_instance_history.py")
 
-def build_ec2_last_month_usage():
-    os.system("src/get_last_month_ec2_cost.py")
-
-def build_ebs_last_month_usage():
-    os.system("src/get_last_month_ebs_cost.py")
-
-def build_s3_cost():
-    os.system("src/get_s3_cost.py")
+def build_billing_data():
+    os.system("src/process_billing.py")
 
 def build_gsheet():
     os.system("src/make_gsheet.py")
@@ -141,6 +162,105 @@ def build_gsheet():
 def build_xlsx(name):
     os.system("src/make_xlsx.py {}".format(name))
 
+def link_file(source, destination):
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
+            return
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+class ReportFormatError(Exception):
+    """ReportFormatError is raised for a report file which cannot be read
+    however many times it is downloaded."""
+
+
+def with_retries(description, fct, *args, **kwargs):
+    for attempt in itertools.count(1):
+        try:
+            return fct(*args, **kwargs)
+        except ReportFormatError:
+            raise
+        except Exception as e:
+            if attempt >= download_attempts:
+                raise
+            delay = download_backoff * 2 ** (attempt - 1)
+            print("    Failed to get {} ({}), retrying in {:.1f}s...".format(description, e, delay))
+            time.sleep(delay)
+
+
+def get_object_range(s3_client, bucket, key, first, last):
+    body = s3_client.get_object(Bucket=bucket, Key=key, Range="bytes={}-{}".format(first, last))["Body"]
+    return body.read()
+
+
+class RangedObjectReader(io.RawIOBase):
+    """RangedObjectReader reads an S3 object as a stream while its parts are
+    fetched with ranged GETs on a thread pool, a few parts ahead of the
+    reader."""
+    def __init__(self, s3_client, bucket, key, size, pool):
+        self._fetch = lambda first, last: with_retries(
+            "{} [{}-{}]".format(key, first, last),
+            get_object_range, s3_client, bucket, key, first, last,
+        )
+        self._size = size
+        self._pool = pool
+        self._offsets = iter(range(0, size, download_part_size))
+        self._pending = collections.deque()
+        self._buffer = memoryview(b"")
+        for _ in range(download_parts_ahead):
+            self._schedule()
+
+    def _schedule(self):
+        first = next(self._offsets, None)
+        if first is not None:
+            last = min(first + download_part_size, self._size) - 1
+            self._pending.append(self._pool.submit(self._fetch, first, last))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self._buffer):
+            if not self._pending:
+                return 0
+            self._buffer = memoryview(self._pending.popleft().result())
+            self._schedule()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def open_report(s3_client, bucket, report_key, size, range_pool):
+    if size >= download_multipart_threshold:
+        return io.BufferedReader(RangedObjectReader(s3_client, bucket, report_key, size, range_pool), download_part_size)
+    return s3_client.get_object(Bucket=bucket, Key=report_key)["Body"]
+
+
+def extract_report(s3_client, bucket, report_key, size, file_name, range_pool):
+    body = open_report(s3_client, bucket, report_key, size, range_pool)
+    with open(file_name, "wb") as f:
+        if report_key.endswith(".zip"):
+            # Zip archives need random access to their central directory, so
+            # they cannot be decompressed while they are being downloaded.
+            with tempfile.TemporaryFile() as archive:
+                shutil.copyfileobj(body, archive)
+                with zipfile.ZipFile(archive, "r") as z:
+                    # A report file is stored as a single CSV file, so the
+                    # members of a larger archive cannot all be kept.
+                    if len(z.namelist()) != 1:
+                        raise ReportFormatError("{} holds {} files instead of one".format(report_key, len(z.namelist())))
+                    with z.open(z.namelist()[0]) as zf:
+                        shutil.copyfileobj(zf, f)
+        elif report_key.endswith(".gz"):
+            with gzip.GzipFile(fileobj=body, mode="r") as z:
+                shutil.copyfileobj(z, f)
+        else:
+            shutil.copyfileobj(body, f)
+
 def get_session(profile):
     if profile != 'env':
         session = boto3.Session(profile_name=profile)
@@ -148,79 +268,133 @@ def get_session(profile):
         session = boto3.Session()
     return session
 
-def do_get_billing_data(profile, bucket, prefix):
+def do_get_billing_data(profile, bucket, prefix, download_workers=4):
 
     nonce = hashlib.sha1("{}{}".format(bucket, prefix).encode()).hexdigest()[:12]
-    it = 1
-    concurrent_available = 4
-    concurrent_available_mutex = threading.Lock()
-    thread = []
+    index_path = os.path.join(persistent_usagecost_dir, "{}.json".format(nonce))
+    downloads = []
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    new_index = {}
 
-    def change_concurrent_available(value):
-        nonlocal concurrent_available
-        nonlocal concurrent_available_mutex
+    def stored_file_name(report_key):
+        return "{}.{}.csv".format(nonce, hashlib.sha1(report_key.encode()).hexdigest()[:12])
 
-        concurrent_available_mutex.acquire()
-        concurrent_available += value
-        concurrent_available_mutex.release()
+    def is_stored(file_name):
+        return os.path.isfile(os.path.join(persistent_usagecost_dir, file_name))
 
-    def save_to_file(s3_client, bucket, file_name, report_key):
+    def save_to_file(s3_client, bucket, file_name, report_key, size, range_pool):
+        """save_to_file downloads a report file into the persistent store, and
+        returns whether it succeeded."""
         try:
-            s3_client.download_file(Bucket=bucket, Key=report_key, Filename=file_name)
-        except Exception as e:
-            print(e)
-        finally:
-            change_concurrent_available(1)
-
-    def analyze_report(s3_client, bucket, report_keys):
-        nonlocal it
-        nonlocal thread
-        nonlocal concurrent_available
-        for report_key in report_keys:
-            if concurrent_available <= 0:
-                print("    Waiting to download {}...".format(report_key))
-            while concurrent_available <= 0:
-                time.sleep(0.1)
-            file_name = "in/usagecost/{}.{}.csv.{}".format(nonce, it, report_key.split(".")[-1])
-            t = threading.Thread(name=report_key, target=save_to_file, args=(s3_client, bucket, file_name, report_key))
             print("    Downloading {}...".format(report_key))
-            t.start()
-            change_concurrent_available(-1)
-            thread.append(t)
-            it += 1
+            start = time.time()
+            with_retries(report_key, extract_report, s3_client, bucket, report_key, size, file_name + ".tmp", range_pool)
+            os.rename(file_name + ".tmp", file_name)
+            elapsed = max(time.time() - start, 1e-3)
+            print("    Downloaded {} ({:.1f} MB in {:.1f}s, {:.1f} MB/s).".format(
+                report_key, size / 1e6, elapsed, size / 1e6 / elapsed))
+            return True
+        except Exception as e:
+            print("Failed to download {}: {}".format(report_key, e))
+            return False
 
-    def analyze_obj(s3_client, objs):
+    def analyze_report(s3_client, manifest_key, bucket, report_keys, stored_files, pool, range_pool):
+        files = {}
+        for report_key in report_keys:
+            head = s3_client.head_object(Bucket=bucket, Key=report_key)
+            stored = {
+                "etag": head["ETag"],
+                "size": head["ContentLength"],
+                "file": stored_file_name(report_key),
+            }
+            if stored_files.get(report_key) == stored and is_stored(stored["file"]):
+                print("    {} is unchanged, skipping.".format(report_key))
+                files[report_key] = stored
+                continue
+            # The previous entry is kept until the new file is downloaded, see
+            # record_downloads.
+            if report_key in stored_files:
+                files[report_key] = stored_files[report_key]
+            file_name = os.path.join(persistent_usagecost_dir, stored["file"])
+            downloads.append((manifest_key, files, report_key, stored, pool.submit(
+                save_to_file, s3_client, bucket, file_name, report_key, stored["size"], range_pool)))
+        return files
+
+    def record_downloads():
+        """record_downloads indexes the files which were downloaded. When a
+        download failed, the manifest's ETag is dropped so that its files are
+        checked again on the next run."""
+        for manifest_key, files, report_key, stored, download in downloads:
+            if download.result():
+                files[report_key] = stored
+            else:
+                new_index[manifest_key]["etag"] = None
+
+    def analyze_obj(s3_client, objs, pool, range_pool):
         total = len(objs)
         current = 1
         for obj in objs:
+            entry = index.get(obj["Key"])
+            if entry is not None and entry["etag"] == obj["ETag"] and all(is_stored(f["file"]) for f in entry["files"].values()):
+                print("  Bill files from {} are up to date ({}/{}).".format(obj["Key"], current, total))
+                new_index[obj["Key"]] = entry
+                current += 1
+                continue
             print("  Getting bill files from {} ({}/{})...".format(obj["Key"], current, total))
             content = s3_client.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read().decode("utf-8")
             content_json = json.loads(content)
             if "bucket" in content_json:
-                analyze_report(s3_client, content_json["bucket"], content_json["reportKeys"])
+                new_index[obj["Key"]] = {
+                    "etag": obj["ETag"],
+                    "assemblyId": content_json.get("assemblyId"),
+                    "files": analyze_report(
+                        s3_client,
+                        obj["Key"],
+                        content_json["bucket"],
+                        content_json["reportKeys"],
+                        entry["files"] if entry is not None else {},
+                        pool,
+                        range_pool,
+                    ),
+                }
             current += 1
-        for t in thread:
-            t.join()
-
-    def unzip_obj():
+        record_downloads()
+
+    def save_index():
+        with open(index_path, "w") as f:
+            json.dump(new_index, f)
+        stored_file_names = set(
+            stored["file"]
+            for entry in new_index.values()
+            for stored in entry["files"].values()
+        )
+        for file_name in os.listdir(persistent_usagecost_dir):
+            if file_name.startswith(nonce + ".") and file_name != os.path.basename(index_path) and file_name not in stored_file_names:
+                os.remove(os.path.join(persistent_usagecost_dir, file_name))
+
+    def link_files():
+        stored_file_names = set()
+        for entry in new_index.values():
+            for report_key, stored in entry["files"].items():
+                if not is_stored(stored["file"]):
+                    print("Missing bill file for {}".format(report_key))
+                    continue
+                link_file(os.path.join(persistent_usagecost_dir, stored["file"]), os.path.join("in/usagecost", stored["file"]))
+                stored_file_names.add(stored["file"])
         for file_name in os.listdir("in/usagecost"):
-            try:
-                print("Extracting {}...".format(file_name))
-                if file_name.startswith(nonce) and file_name.endswith(".zip"):
-                    with zipfile.ZipFile(os.path.join("in/usagecost", file_name), "r") as z:
-                        z.extractall("in/usagecost")
-                elif file_name.startswith(nonce) and file_name.endswith(".gz"):
-                    with gzip.GzipFile(os.path.join("in/usagecost", file_name), "r") as z:
-                        with open(os.path.join("in/usagecost", file_name[:-3]), "wb+") as f:
-                            shutil.copyfileobj(z, f)
-            except Exception as e:
-                print("Failed to extract {}: {}".format(file_name, e))
-            finally:
+            if file_name.startswith(nonce) and file_name not in stored_file_names:
                 os.remove(os.path.join("in/usagecost", file_name))
 
     try:
         session = get_session(profile)
-        s3_client = session.client("s3")
+        s3_client = session.client("s3", config=botocore.config.Config(
+            max_pool_connections=download_workers * 2,
+            retries={"max_attempts": download_attempts},
+        ))
         page = s3_client.get_paginator("list_objects").paginate(Bucket=bucket, Prefix=prefix)
         min_date = (datetime.now() + dateutil.relativedelta.relativedelta(months=-6)).replace(day=1).strftime('%Y%m%d')
         objs = [
@@ -233,20 +407,23 @@ def do_get_billing_data(profile, bucket, prefix):
         ]
     except Exception as e:
         exit(e)
-    analyze_obj(s3_client, objs)
-    unzip_obj()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as range_pool:
+        analyze_obj(s3_client, objs, pool, range_pool)
+    save_index()
+    link_files()
 
 
-def do_get_instance_data(profile, region):
-    threads = []
-    for cmd in (
-            "{} src/get_ec2_recommendations.py".format(awsenv(profile, region)),
-            "{} src/get_ec2_metadata.py".format(awsenv(profile, region)),
-        ):
-        threads.append(threading.Thread(target=os.system, args=[cmd]))
-        threads[-1].start()
-    for t in threads:
-        t.join()
+def do_get_instance_data(profile, region, account):
+    os.system("{} src/get_ec2_recommendations.py --account {}".format(awsenv(profile, region), account))
+
+
+def get_inventory_accounts():
+    try:
+        with open("out/instance-inventory/accounts.json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
 
 
 def recursively_remove_file(path):
@@ -281,43 +458,43 @@ def main():
     #     return parser.print_help()
     if args.clear_before:
         clear_data()
-    if not os.path.isfile("in/ondemandcosts.json"):
-        os.system("src/get_ec2_costs.sh")
     for bill in args.billing:
         print("Download billings for {}...".format(bill[0]))
-        do_get_billing_data(*bill)
+        do_get_billing_data(*bill, download_workers=args.download_workers)
+    if len(args.billing):
+        # Caches of files missing from in/usagecost are pruned, so this must
+        # only run once the files of every billing source are linked.
+        build_usagecost_cache()
     if len(args.ec2):
         session = get_session(args.ec2[0])
         regions = get_regions(session)
-        threads = []
-        for region in regions:
-            print("Fetching ec2 data for all accounts in {}...".format(region))
-            cmd = "src/get_ec2_data.py --region {} --profile {}".format(region, ' '.join(args.ec2))
-            threads.append((region, threading.Thread(target=os.system, args=[cmd])))
-            threads[-1][1].start()
-        for t in threads:
-            t[1].join()
-            print("Fetched ec2 data for all accounts in {}".format(t[0]))
+        print("Updating on-demand prices...")
+        os.system("src/get_ec2_costs.py --region {}".format(' '.join(regions)))
+        print("Listing instances for all accounts in {}...".format(', '.join(regions)))
+        os.system("src/get_ec2_inventory.py --region {} --profile {}".format(' '.join(regions), ' '.join(args.ec2)))
+        accounts = get_inventory_accounts()
+        print("Fetching ec2 data for all accounts in {}...".format(', '.join(regions)))
+        os.system("src/get_ec2_data.py --region {} --profile {} --matching {}".format(
+            ' '.join(regions),
+            ' '.join(args.ec2),
+            "size-flexible" if args.size_flexible_matching else "exact",
+        ))
+        print("Fetched ec2 data for all accounts")
         for ec in args.ec2:
+            if ec not in accounts:
+                print("No instance inventory for {}, skipping recommendations".format(ec))
+                continue
             threads = []
             for region in regions:
-                print("Fetching ec2 metadata for {} in {}...".format(ec, region))
-                threads.append((region, threading.Thread(target=do_get_instance_data, args=(ec, region))))
+                print("Fetching ec2 recommendations for {} in {}...".format(ec, region))
+                threads.append((region, threading.Thread(target=do_get_instance_data, args=(ec, region, accounts[ec]))))
                 threads[-1][1].start()
             for t in threads:
                 t[1].join()
-                print("Fetched ec2 metadata for {} in {}".format(ec, t[0]))
+                print("Fetched ec2 recommendations for {} in {}".format(ec, t[0]))
     if args.generate_gsheet or args.generate_xslx:
-        fcts = [
-            ("billing diff", build_billing_diff),
-            ("instance history", build_instance_history),
-            ("ec2 last month", build_ec2_last_month_usage),
-            ("ebs last month", build_ebs_last_month_usage),
-            ("s3 cost", build_s3_cost)
-        ]
-        for i, fct in zip(itertools.count(1), fcts):
-            print("Processing billing data ({}/{} - {})...".format(i, len(fcts), fct[0]))
-            fct[1]()
+        print("Processing billing data...")
+        build_billing_data()
         if args.generate_gsheet:
             build_gsheet()
         if args.generate_xslx:
@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+
+import sys
+
+import usagecost
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        for filepath in sys.argv[1:]:
+            usagecost.cache_file(filepath)
+    else:
+        usagecost.build_cache()
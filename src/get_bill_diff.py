@@ -1,97 +1,131 @@
 #!/usr/bin/env python3
 
+import argparse
 import csv
-import sys
 import collections
-import datetime
-import itertools
-import os
 
-DIR_USAGECOST='in/usagecost'
+import numpy
+
+import usagecost
+
 OUT_MONTHS='out/months.csv'
 OUT_ABSOLUTE='out/absolute.csv'
 
-def rows_folder(dirpath):
-    for filename in os.listdir(dirpath):
-        filepath = os.path.join(dirpath, filename)
-        with open(filepath) as f:
-            for row in rows(f):
-                yield row
-
-def parseIsoDatetime(isodatetime):
-    return datetime.datetime.strptime(isodatetime.replace('Z', '+0000'), '%Y-%m-%dT%H:%M:%S%z')
-
-def rows(csvfile):
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        yield row
-
-def window(l, n=2):
-    for i in range(len(l) - n + 1):
-        yield l[i:i+n]
-
-def variations(costs):
-    return [
-        "" if old <= .0 else (new / old) - 1
-        for [old, new] in window([0, *costs])
-    ]
+SUPPORT_PRODUCT_CODE = 'AWSSupportBusiness'
+EPOCH_MONTH_INDEX = 1970 * 12
 
 def yearmonth_to_string(yearmonth):
     year, month = divmod(yearmonth, 12)
     return '{:04d}-{:02d}'.format(year, month + 1)
 
-first_month = -1
-last_month = -1
-breakdown = collections.defaultdict(float)
-
-for row in rows_folder(DIR_USAGECOST):
-    usage_start_date = parseIsoDatetime(row['lineItem/UsageStartDate'])
-    month = usage_start_date.year * 12 + usage_start_date.month - 1
-    first_month = month if first_month == -1 else min(month, first_month)
-    last_month = month if last_month == -1 else max(month, last_month)
-    usagetype = row['lineItem/UsageType']
-    # do not process if it is a line item for AWS support
-    if row['lineItem/ProductCode'] == 'AWSSupportBusiness':
-        continue
-    try:
-        breakdown[(month, usagetype)] += float(row['lineItem/UnblendedCost'])# if row['lineItem/UnblendedCost'] else 0.0
-    except:
-        print(row, file=sys.stderr)
-        print(month, file=sys.stderr)
-        print(usagetype, file=sys.stderr)
-
-all_months = sorted(set(k[0] for k in breakdown.keys()))
-preserved_months = all_months[-12:]
-first_month = preserved_months[0]
-last_month = preserved_months[-1]
-breakdown = {
-    (month, usagetype): value
-    for (month, usagetype), value in breakdown.items()
-    if month in preserved_months
+class MonthlyBreakdown:
+    """MonthlyBreakdown aggregates the cost of line items per month and usage
+    type."""
+    columns = [
+        'lineItem/UsageStartDate',
+        'lineItem/UsageType',
+        'lineItem/ProductCode',
+        'lineItem/UnblendedCost',
+    ]
+
+    def __init__(self):
+        self.breakdown = collections.defaultdict(float)
+
+    def add(self, row):
+        month = usagecost.month_index(row['lineItem/UsageStartDate'])
+        # reports may lack some columns, which then read as empty strings
+        usagetype = row.get('lineItem/UsageType', '')
+        # do not process if it is a line item for AWS support
+        if row.get('lineItem/ProductCode', '') == SUPPORT_PRODUCT_CODE:
+            return
+        self.breakdown[(month, usagetype)] += row['lineItem/UnblendedCost']
+
+    def merge(self, other):
+        for key, value in other.breakdown.items():
+            self.breakdown[key] += value
+
+    def write(self):
+        all_months = sorted(set(k[0] for k in self.breakdown.keys()))
+        preserved_months = all_months[-12:]
+        first_month = preserved_months[0]
+        last_month = preserved_months[-1]
+        breakdown = {
+            (month, usagetype): value
+            for (month, usagetype), value in self.breakdown.items()
+            if month in preserved_months
+        }
+
+        with open(OUT_MONTHS, 'w') as monthsfile:
+            writer = csv.writer(monthsfile)
+            writer.writerow(['month', 'usage', 'cost'])
+            for key, value in breakdown.items():
+                writer.writerow([*key, value])
+
+        products = {}
+        for (_, product) in breakdown.keys():
+            products.setdefault(product, len(products))
+        breakdown_by_date = numpy.zeros((len(products), last_month - first_month + 1))
+        if breakdown:
+            keys = numpy.array([(products[product], month - first_month) for (month, product) in breakdown.keys()])
+            numpy.add.at(breakdown_by_date, (keys[:, 0], keys[:, 1]), numpy.fromiter(breakdown.values(), dtype=float))
+
+        with open(OUT_ABSOLUTE, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['usage'] + [yearmonth_to_string(ym) for ym in range(first_month, last_month + 1)])
+            for product, month_cost in zip(products, breakdown_by_date.tolist()):
+                writer.writerow([product, *month_cost])
+
+class NumpyMonthlyBreakdown(MonthlyBreakdown):
+    """NumpyMonthlyBreakdown computes the same breakdown as MonthlyBreakdown
+    from batches of columns, with vectorized operations instead of one
+    dictionary update per line item."""
+    def __init__(self):
+        super().__init__()
+        self.usage_type_codes = {}
+        self.usage_types = []
+
+    def _usage_type_code(self, usage_type):
+        code = self.usage_type_codes.get(usage_type)
+        if code is None:
+            code = self.usage_type_codes[usage_type] = len(self.usage_types)
+            self.usage_types.append(usage_type)
+        return code
+
+    @staticmethod
+    def _string_column(batch, column, rows):
+        # As in MonthlyBreakdown.add, a missing column reads as empty strings.
+        return batch.get(column, (numpy.zeros(rows, dtype=numpy.int64), ['']))
+
+    def add_batch(self, batch):
+        timestamps, _ = batch['lineItem/UsageStartDate']
+        if not len(timestamps):
+            return
+        usage_type_codes, usage_types = self._string_column(batch, 'lineItem/UsageType', len(timestamps))
+        product_codes, products = self._string_column(batch, 'lineItem/ProductCode', len(timestamps))
+        costs, _ = batch['lineItem/UnblendedCost']
+        # do not process line items for AWS support
+        kept = numpy.array([product != SUPPORT_PRODUCT_CODE for product in products], dtype=bool)[product_codes]
+        months = timestamps[kept].astype('datetime64[s]').astype('datetime64[M]').astype(numpy.int64)
+        usage_types = numpy.array([self._usage_type_code(usage_type) for usage_type in usage_types], dtype=numpy.int64)[usage_type_codes[kept]]
+        if not len(months):
+            return
+        first_month = months.min()
+        month_count = months.max() - first_month + 1
+        keys = (months - first_month) * len(self.usage_types) + usage_types
+        key_count = month_count * len(self.usage_types)
+        sums = numpy.bincount(keys, weights=costs[kept], minlength=key_count)
+        present = numpy.flatnonzero(numpy.bincount(keys, minlength=key_count))
+        for key, cost in zip(present.tolist(), sums[present].tolist()):
+            month, usage_type = divmod(key, len(self.usage_types))
+            self.breakdown[(EPOCH_MONTH_INDEX + int(first_month) + month, self.usage_types[usage_type])] += cost
+
+ENGINES = {
+    'python': MonthlyBreakdown,
+    'numpy': NumpyMonthlyBreakdown,
 }
 
-with open(OUT_MONTHS, 'w') as monthsfile:
-    writer = csv.writer(monthsfile)
-    writer.writerow(['month', 'usage', 'cost'])
-    for key, value in breakdown.items():
-        writer.writerow([*key, value])
-
-#with open('months.csv') as monthsfile:
-#    for row in rows(monthsfile):
-#        breakdown[(int(row['month']), row['usage'])] = float(row['cost'])
-#        first_month = int(row['month']) if first_month == -1 else min(int(row['month']), first_month)
-#        last_month = int(row['month']) if last_month == -1 else max(int(row['month']), last_month)
-
-breakdown_by_date = collections.defaultdict(lambda: list([.0] * (last_month - first_month + 1)))
-for (month, product), cost in breakdown.items():
-    breakdown_by_date[product][month - first_month] += cost
-
-with open(OUT_ABSOLUTE, 'w') as f:
-    writer = csv.writer(f)
-    writer.writerow(['usage'] + [yearmonth_to_string(ym) for ym in range(first_month, last_month + 1)])
-    for product, month_cost in breakdown_by_date.items():
-        writer.writerow([product, *month_cost])
-
-breakdown_variation = {}
-for (product, monthly_costs) in breakdown_by_date.items():
-    breakdown_variation[product] = variations(monthly_costs)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', help='aggregation engine', choices=ENGINES.keys(), default='python')
+    args = parser.parse_args()
+    usagecost.run([ENGINES[args.engine]()])
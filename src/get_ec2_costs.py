@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import io
+import json
+import os
+import urllib.parse
+import urllib.request
+
+import pricing
+
+PRICING_ENDPOINT = 'https://pricing.us-east-1.amazonaws.com'
+OFFER_URL = PRICING_ENDPOINT + '/offers/v1.0/aws/AmazonEC2/current/index.json'
+REGION_INDEX_URL = PRICING_ENDPOINT + '/offers/v1.0/aws/AmazonEC2/current/region_index.json'
+CHUNK_SIZE = 1 << 20
+PRODUCT_FAMILY = 'Compute Instance'
+
+class JsonStream:
+    """JsonStream walks a JSON document read from a text file without loading
+    it whole. Objects are iterated member by member with members(), and only
+    the values read with value() are decoded, one at a time."""
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.pos > self.chunk_size:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += chunk
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError('unexpected end of JSON document')
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError('expected {!r} at offset {} of the JSON buffer'.format(c, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """value decodes the next value of the document. A value is complete
+        once something follows it in the buffer, which keeps numbers from
+        being cut at the end of a chunk."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            if end < len(self.buffer) or not self._fill():
+                self.pos = end
+                return value
+
+    def members(self):
+        """members yields the keys of the next object of the document. The
+        caller consumes the value of each key before asking for the next
+        one."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+    def skip(self):
+        """skip consumes the next value of the document, decoding the members
+        of an object one by one rather than as a whole."""
+        if self.peek() == '{':
+            for _ in self.members():
+                self.value()
+        else:
+            self.value()
+
+def ondemand_cost(terms):
+    """ondemand_cost returns the price per unit of the first price dimension
+    of the first on-demand term of a product."""
+    term = next(iter(terms.values()))
+    dimension = next(iter(term['priceDimensions'].values()))
+    return float(dimension['pricePerUnit']['USD'])
+
+def read_offer(f, publication_date=None, chunk_size=CHUNK_SIZE):
+    """read_offer returns the publication date of an EC2 offer file and the
+    price rows of its compute instances which have on-demand terms, in
+    product order. The rows are None when the offer was published at
+    publication_date, in which case the products are not read."""
+    stream = JsonStream(f, chunk_size)
+    offer_publication_date = None
+    products = {}
+    costs = {}
+    for key in stream.members():
+        if key == 'publicationDate':
+            offer_publication_date = stream.value()
+            if publication_date is not None and offer_publication_date == publication_date:
+                return offer_publication_date, None
+        elif key == 'products':
+            for sku in stream.members():
+                product = stream.value()
+                if product.get('productFamily') == PRODUCT_FAMILY:
+                    # Only the attributes of the price rows are kept while
+                    # the terms are read.
+                    products[sku] = pricing.price_attributes(product['attributes'])
+        elif key == 'terms':
+            for term_type in stream.members():
+                if term_type != 'OnDemand':
+                    stream.skip()
+                    continue
+                for sku in stream.members():
+                    terms = stream.value()
+                    if sku in products:
+                        costs[sku] = ondemand_cost(terms)
+        else:
+            stream.skip()
+    return offer_publication_date, [
+        pricing.price_row(attributes, costs[sku])
+        for sku, attributes in products.items()
+        if sku in costs
+    ]
+
+def open_offer(location):
+    if urllib.parse.urlparse(location).scheme in ('http', 'https'):
+        return io.TextIOWrapper(urllib.request.urlopen(location), encoding='utf-8')
+    return open(location, encoding='utf-8')
+
+def region_offer_urls(regions):
+    """region_offer_urls returns the URL of the current offer file of each
+    region, which changes with every new version of the region's prices."""
+    with urllib.request.urlopen(REGION_INDEX_URL) as f:
+        region_index = json.load(io.TextIOWrapper(f, encoding='utf-8'))
+    urls = {}
+    for region in regions:
+        if region in region_index['regions']:
+            urls[region] = PRICING_ENDPOINT + region_index['regions'][region]['currentVersionUrl']
+        else:
+            print('Error: no offer file for region {}'.format(region))
+    return urls
+
+def update_cache(offers, cachedir=pricing.DIR_PRICING):
+    """update_cache reads (offer, region) pairs into the region tables of
+    the pricing cache. The prices of an offer without a region are split by
+    the region of each product, and those of products without a known region
+    are reported and left out. Offers already cached at the same URL and
+    publication date are not read."""
+    manifest = pricing.read_manifest(cachedir)
+    for offer, region in offers:
+        cached = [
+            entry
+            for cached_region, entry in manifest['regions'].items()
+            if entry['offer'] == offer and region in (None, cached_region)
+        ]
+        if region is not None and cached:
+            print('Prices of {} are up to date'.format(region))
+            continue
+        with open_offer(offer) as f:
+            publication_date, prices = read_offer(f, cached[0]['publicationDate'] if cached else None)
+        if prices is None:
+            print('Prices of {} did not change since {}'.format(offer, publication_date))
+            continue
+        tables = collections.defaultdict(list)
+        unknown_locations = set()
+        for row in prices:
+            table_region = region or row[5]
+            if table_region is None:
+                unknown_locations.add(row[1])
+            else:
+                tables[table_region].append(row)
+        for location in sorted(unknown_locations, key=str):
+            print('Error: no region for location {}, its prices are not cached'.format(location))
+        for table_region, rows in tables.items():
+            pricing.write_region(rows, table_region, cachedir)
+            manifest['regions'][table_region] = {'offer': offer, 'publicationDate': publication_date}
+        pricing.write_manifest(manifest, cachedir)
+        print('Cached {} prices of {} regions from {}'.format(len(prices), len(tables), offer))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--region', help='read the offer files of these regions instead of the global one', nargs='+', default=[])
+    parser.add_argument('--offer-file', help='read these local offer files', nargs='+', default=[])
+    args = parser.parse_args()
+    os.makedirs(pricing.DIR_PRICING, exist_ok=True)
+    if args.offer_file:
+        offers = [(offer, None) for offer in args.offer_file]
+    elif args.region:
+        offers = [(offer, region) for region, offer in region_offer_urls(args.region).items()]
+    else:
+        offers = [(OFFER_URL, None)]
+    update_cache(offers)
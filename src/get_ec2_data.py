@@ -4,34 +4,20 @@ import collections
 import csv
 import itertools
 import json
+import os
 import re
 import argparse
+import concurrent.futures
 import multiprocessing.pool
+import threading
+import time
 from pprint import pprint
-import boto3
-import botocore
 
 from mytypes import *
-
-compute_sheet_region = {
-    'us-east-2': 'US East (Ohio)',
-    'us-east-1': 'US East (N. Virginia)',
-    'us-west-1': 'US West (N. California)',
-    'us-west-2': 'US West (Oregon)',
-    'ap-northeast-1': 'Asia Pacific (Tokyo)',
-    'ap-northeast-2': 'Asia Pacific (Seoul)',
-    'ap-south-1': 'Asia Pacific (Mumbai)',
-    'ap-southeast-1': 'Asia Pacific (Singapore)',
-    'ap-southeast-2': 'Asia Pacific (Sydney)',
-    'ca-central-1': 'Canada (Central)',
-    'cn-north-1': 'China (Beijing)',
-    'cn-northwest-1': 'China (Ningxia)',
-    'eu-central-1': 'EU (Frankfurt)',
-    'eu-west-1': 'EU (Ireland)',
-    'eu-west-2': 'EU (London)',
-    'eu-west-3': 'EU (Paris)',
-    'sa-east-1': 'South America (Sao Paulo)',
-}
+from instancesize import normalization_factor, str_to_instance_size
+import inventory
+import pricing
+import ratelimit
 
 compute_sheet_tenancy = {
     'dedicated': 'Dedicated',
@@ -67,10 +53,10 @@ compute_sheet_platform = {
 DIR_BILLS = 'in/usagecost'
 DIR_INSTANCE_RESERVATION_USAGE = 'out/instance-reservation-usage'
 DIR_RESERVATION_USAGE = 'out/reservation-usage'
-FIL_ONDEMAND_COSTS = 'in/ondemandcosts.json'
+DIR_OFFERINGS = 'in/persistent/offerings'
+OFFERINGS_TTL = 24 * 3600
 
-with open(FIL_ONDEMAND_COSTS) as f:
-    compute_instance_costs = json.load(f)
+ondemand_costs = pricing.PriceIndex()
 
 _az_to_region_re = re.compile(r'^(.+?)[a-z]?$')
 
@@ -84,16 +70,22 @@ def identity(x):
 
 
 boto_sessions = {}
+boto_clients = {}
+boto_lock = threading.Lock()
 
 
 def boto_session_getter(profile, region):
-    global boto_sessions
-    if (profile, region) in boto_sessions:
-        return boto_sessions[(profile, region)]
-    session = boto3.Session(profile_name=profile, region_name=region)
-    ec2 = session.client('ec2')
-    boto_sessions[(profile, region)] = ec2
-    return ec2
+    """boto_session_getter returns the EC2 client of a profile in a region.
+    Regions are processed concurrently, so the session of each profile and
+    its clients are created once under a lock and shared by all threads."""
+    with boto_lock:
+        if (profile, region) in boto_clients:
+            return boto_clients[(profile, region)]
+        if profile not in boto_sessions:
+            boto_sessions[profile] = inventory.get_session(profile)
+        ec2 = ratelimit.client(boto_sessions[profile], 'ec2', region)
+        boto_clients[(profile, region)] = ec2
+        return ec2
 
 
 def reserved_instance_offering_cost_per_hour(offering):
@@ -134,35 +126,16 @@ def get_reserved_instances(ec2, region):
     ]
 
 
-def get_ondemand_instance_types(ec2, profile):
+ONDEMAND_INSTANCE_STATES = frozenset(['pending', 'running'])
+ONDEMAND_INSTANCE_TENANCIES = frozenset(['dedicated', 'default'])
+
+
+def get_ondemand_instance_types(instances, profile):
     def get_instance_type(instance_type):
         if instance_type == "windows":
             return "Windows"
         return instance_type
 
-    instance_paginator = ec2.get_paginator('describe_instances')
-    pages = instance_paginator.paginate(
-        Filters=[
-            {
-                'Name': 'instance-state-name',
-                'Values': [
-                    'pending',
-                    'running',
-                ],
-            },
-            {
-                'Name': 'tenancy',
-                'Values': [
-                    'dedicated',
-                    'default',
-                ],
-            }
-        ]
-    )
-    reservations = itertools.chain.from_iterable(
-        p['Reservations'] for p in pages)
-    instances = itertools.chain.from_iterable(
-        r['Instances'] for r in reservations)
     return [
         InstanceTypeWithProfile(
             profile=profile,
@@ -176,14 +149,113 @@ def get_ondemand_instance_types(ec2, profile):
         )
         for i in instances
         if i.get('InstanceLifecycle', 'ondemand') == 'ondemand'
+        and i['State']['Name'] in ONDEMAND_INSTANCE_STATES
+        and i['Placement']['Tenancy'] in ONDEMAND_INSTANCE_TENANCIES
     ]
 
 
-def get_ec2_type_offerings(ec2, instance_type):
+def get_profile_instances(profile, region):
+    """get_profile_instances returns the instances of a profile in a region
+    from the inventory collected by get_ec2_inventory.py, and lists them when
+    they were not collected."""
+    account = inventory.read_accounts().get(profile)
+    instances = inventory.read_inventory(account, region) if account else None
+    if instances is None:
+        instances = inventory.describe_instances(
+            boto_session_getter(profile, region))
+    return instances
+
+
+def get_ondemand_cost(instance_type):
+    return ondemand_costs.ondemand_cost(
+        az_to_region(instance_type.availability_zone),
+        instance_type.size,
+        compute_sheet_tenancy.get(instance_type.tenancy),
+        compute_sheet_platform.get(instance_type.product),
+    )
+
+
+class OfferingCache:
+    """OfferingCache memoizes the hourly cost of the best and worst reserved
+    instance offerings of a region per (size, tenancy, product), for all
+    profiles, or None when there is no offering. Costs are persisted per
+    region and fetched again once older than the TTL. Concurrent lookups of
+    the same key wait for a single fetch. A fetch which fails is reported and
+    its key looked up as None for the rest of the run, so only that offering
+    is skipped; failures are not persisted."""
+    def __init__(self, region, cachedir=DIR_OFFERINGS, ttl=OFFERINGS_TTL):
+        self.path = os.path.join(cachedir, '{}.json'.format(region))
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.entries = {}
+        self.failed = set()
+        try:
+            with open(self.path) as f:
+                for size, tenancy, product, fetched, costs in json.load(f):
+                    self.entries[(size, tenancy, product)] = (fetched, costs)
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError):
+            print('Error: corrupt offering cache {}, starting empty'.format(self.path))
+            self.entries = {}
+
+    def _fresh(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and time.time() - entry[0] < self.ttl
+
+    def get(self, key, fetch):
+        with self.lock:
+            if key in self.failed:
+                return None
+            if self._fresh(key):
+                return self.entries[key][1]
+            fetching = self.pending.get(key)
+            if fetching is None:
+                fetching = self.pending[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            fetching.wait()
+            with self.lock:
+                if key in self.failed or not self._fresh(key):
+                    return None
+                return self.entries[key][1]
+        try:
+            costs = fetch()
+        except Exception as e:
+            print('Error: failed to fetch offerings for {}: {}'.format(key, e))
+            with self.lock:
+                self.failed.add(key)
+            return None
+        else:
+            with self.lock:
+                self.entries[key] = (time.time(), costs)
+            return costs
+        finally:
+            with self.lock:
+                del self.pending[key]
+            fetching.set()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmppath = self.path + '.tmp'
+        with self.lock, open(tmppath, 'w') as f:
+            json.dump([
+                [*key, fetched, costs]
+                for key, (fetched, costs) in self.entries.items()
+                if self._fresh(key)
+            ], f)
+        os.replace(tmppath, self.path)
+
+
+def get_reserved_offering_costs(ec2, instance_type):
     offerings = itertools.chain.from_iterable(
         page['ReservedInstancesOfferings']
         for page in
-        ec2.get_paginator('describe_reserved_instances_offerings').paginate(
+        ec2.paginate(
+            'describe_reserved_instances_offerings',
             IncludeMarketplace=False,
             InstanceTenancy=instance_type.tenancy,
             ProductDescription=instance_type.product,
@@ -195,49 +267,48 @@ def get_ec2_type_offerings(ec2, instance_type):
             ],
         )
     )
-    try:
-        offerings = sorted(offerings,
-                           key=reserved_instance_offering_cost_per_hour)
-    except botocore.exceptions.ClientError:
-        # Handling api limits
-        return get_ec2_type_offerings(ec2, instance_type)
+    offerings = sorted(offerings, key=reserved_instance_offering_cost_per_hour)
     try:
         offering_best = offerings[0]
         offering_worst = offerings[-1]
     except IndexError:
         return None
-    ondemand = next(
-        c
-        for c in compute_instance_costs
-        if (
-                c['attributes']['instanceType'] == instance_type.size
-                and c['attributes']['location'] == compute_sheet_region.get(
-            az_to_region(instance_type.availability_zone),
-            az_to_region(instance_type.availability_zone))
-                and c['attributes']['tenancy'] == compute_sheet_tenancy[
-                    instance_type.tenancy]
-                and c['attributes']['operatingSystem'] ==
-                compute_sheet_platform[instance_type.product]
-        )
-    )['cost']
+    return [
+        reserved_instance_offering_cost_per_hour(offering_best),
+        reserved_instance_offering_cost_per_hour(offering_worst),
+    ]
+
+
+def get_ec2_type_offerings(ec2, instance_type, offering_cache):
+    ondemand = get_ondemand_cost(instance_type)
+    if ondemand is None:
+        print('Error: no on-demand price for {} ({}, {}, {})'.format(
+            instance_type.size, instance_type.availability_zone,
+            instance_type.tenancy, instance_type.product))
+        return None
+    costs = offering_cache.get(
+        (instance_type.size, instance_type.tenancy, instance_type.product),
+        lambda: get_reserved_offering_costs(ec2, instance_type),
+    )
+    if costs is None:
+        return None
     res = InstanceOffering(
         type=instance_type,
-        cost_reserved_worst=reserved_instance_offering_cost_per_hour(
-            offering_worst),
-        cost_reserved_best=reserved_instance_offering_cost_per_hour(
-            offering_best),
+        cost_reserved_worst=costs[1],
+        cost_reserved_best=costs[0],
         cost_ondemand=ondemand,
     )
     return res
 
 
-def instance_type_matches(pattern, example):
-    def get_generic_type(instancetype):
-        if instancetype.lower().startswith(
-                'windows') or instancetype.lower().startswith('suse'):
-            return instancetype
-        return 'Linux/UNIX'
+def get_generic_type(instancetype):
+    if instancetype.lower().startswith(
+            'windows') or instancetype.lower().startswith('suse'):
+        return instancetype
+    return 'Linux/UNIX'
+
 
+def instance_type_matches(pattern, example):
     tmpPattern = pattern.type._replace(
         product=get_generic_type(pattern.type.product))
     tmpExample = example._replace(
@@ -259,6 +330,36 @@ def instance_type_matches(pattern, example):
                                                       example.availability_zone)))
 
 
+def reservation_index_keys(instance_reservation):
+    """reservation_index_keys returns the keys a reservation is indexed by in
+    get_instance_matchings: its type with a generic product, and the same
+    type without product, since instance_type_matches ignores the product of
+    instances when it compares their region."""
+    pattern = instance_reservation.type._replace(
+        product=get_generic_type(instance_reservation.type.product))
+    return pattern, pattern._replace(product=None)
+
+
+def instance_type_match_keys(example):
+    """instance_type_match_keys returns the keys of the reservations which
+    instance_type_matches can match with an instance type, as product
+    specific and product agnostic keys."""
+    region = az_to_region(example.availability_zone)
+    anyproduct = example._replace(product=None)
+    if example.vpc == True:
+        return (
+            [example, example._replace(vpc=False)],
+            [anyproduct._replace(vpc=False, availability_zone=region),
+             anyproduct._replace(availability_zone=region)],
+        )
+    else:
+        return (
+            [example, example._replace(availability_zone=region)],
+            [anyproduct._replace(vpc=True),
+             anyproduct._replace(vpc=True, availability_zone=region)],
+        )
+
+
 def get_instance_matchings(offerings, reservations):
     instance_offerings_counted = [
         InstanceOfferingCount(
@@ -272,14 +373,34 @@ def get_instance_matchings(offerings, reservations):
         [ri, count]
         for ri, count in reservations.items()
     ]
+    # Reservations are considered in the same order for every instance, so
+    # they are sorted once and bucketed by key, each bucket keeping that
+    # order. An instance only goes through the buckets of its keys.
+    sorted_reserved_instances = sorted(
+        remaining_reserved_instances, reverse=True,
+        key=lambda i: i[0].type.availability_zone[::-1])
+    reserved_by_type = collections.defaultdict(list)
+    reserved_by_type_any_product = collections.defaultdict(list)
+    for rank, rri in enumerate(sorted_reserved_instances):
+        pattern, pattern_any_product = reservation_index_keys(rri[0])
+        reserved_by_type[pattern].append(rank)
+        reserved_by_type_any_product[pattern_any_product].append(rank)
     matched_instances = []
     for oi in sorted(instance_offerings_counted, reverse=True,
                      key=lambda x: x.instance_offering.type.availability_zone[
                                    ::-1]):
+        keys, keys_any_product = instance_type_match_keys(
+            oi.instance_offering.type)
+        candidates = sorted(set(itertools.chain(
+            itertools.chain.from_iterable(
+                reserved_by_type.get(key, ()) for key in keys),
+            itertools.chain.from_iterable(
+                reserved_by_type_any_product.get(key, ())
+                for key in keys_any_product),
+        )))
         matching_reserved = (
             rri
-            for rri in sorted(remaining_reserved_instances, reverse=True,
-                              key=lambda i: i[0].type.availability_zone[::-1])
+            for rri in (sorted_reserved_instances[rank] for rank in candidates)
             if rri[1] > 0 and instance_type_matches(rri[0], oi.instance_offering.type)
         )
         reserved = 0
@@ -303,6 +424,101 @@ def get_instance_matchings(offerings, reservations):
     return matched_instances, reservation_usage
 
 
+SIZE_FLEXIBLE_PRODUCTS = frozenset(['Linux/UNIX', 'Linux/UNIX (Amazon VPC)'])
+
+
+def instance_type_factor(instance_type):
+    return normalization_factor(str_to_instance_size(instance_type.size).size)
+
+
+def size_flexible_pool(instance_type, regional):
+    """size_flexible_pool returns the (family, region) whose reservations
+    can cover an instance type of any size, or None when its capacity is not
+    size flexible: only regional reservations of Linux/UNIX instances with
+    default tenancy and known normalization factor are."""
+    instance_size = str_to_instance_size(instance_type.size)
+    if (instance_size is None
+            or normalization_factor(instance_size.size) is None
+            or instance_type.tenancy != 'default'
+            or instance_type.product not in SIZE_FLEXIBLE_PRODUCTS):
+        return None
+    region = az_to_region(instance_type.availability_zone)
+    if regional and region != instance_type.availability_zone:
+        return None
+    return instance_size.family, region
+
+
+def get_size_flexible_instance_matchings(offerings, reservations):
+    """get_size_flexible_instance_matchings first matches instances with
+    reservations as get_instance_matchings does. The reservation capacity
+    left in each family and region is then pooled in normalization units and
+    spent on the instances left, from the smallest to the largest as AWS
+    applies it. Reservations are drawn from in matching order, and one is
+    counted as used as soon as part of it is."""
+    matched_instances, reservation_usage = get_instance_matchings(
+        offerings, reservations)
+    reserved_pools = collections.defaultdict(list)
+    for ru in sorted(reservation_usage, reverse=True,
+                     key=lambda ru: ru.instance_reservation.type.availability_zone[::-1]):
+        pool = size_flexible_pool(ru.instance_reservation.type, regional=True)
+        if pool is not None and ru.count_used < ru.count:
+            factor = instance_type_factor(ru.instance_reservation.type)
+            reserved_pools[pool].append([
+                ru.instance_reservation,
+                factor,
+                (ru.count - ru.count_used) * factor,
+            ])
+    instance_pools = collections.defaultdict(list)
+    for index, mi in enumerate(matched_instances):
+        pool = size_flexible_pool(mi.instance_offering.type, regional=False)
+        if pool is not None and pool in reserved_pools and mi.count_reserved < mi.count:
+            instance_pools[pool].append(index)
+    flexible_units_used = collections.defaultdict(int)
+    for pool, indexes in instance_pools.items():
+        reserved = reserved_pools[pool]
+        available = sum(units for _, _, units in reserved)
+        current = 0
+        for index in sorted(indexes, key=lambda i: instance_type_factor(
+                matched_instances[i].instance_offering.type)):
+            mi = matched_instances[index]
+            factor = instance_type_factor(mi.instance_offering.type)
+            covered = min(mi.count - mi.count_reserved, available // factor)
+            if covered == 0:
+                continue
+            matched_instances[index] = mi._replace(
+                count_reserved=mi.count_reserved + covered)
+            needed = covered * factor
+            available -= needed
+            while needed > 0:
+                ri = reserved[current]
+                use = min(ri[2], needed)
+                ri[2] -= use
+                needed -= use
+                flexible_units_used[ri[0]] += use
+                if ri[2] == 0:
+                    current += 1
+    factors = {
+        ri: factor
+        for pool in reserved_pools.values()
+        for ri, factor, _ in pool
+    }
+    reservation_usage = [
+        ru._replace(count_used=ru.count_used + (
+            flexible_units_used[ru.instance_reservation]
+            + factors[ru.instance_reservation] - 1
+        ) // factors[ru.instance_reservation])
+        if ru.instance_reservation in flexible_units_used else ru
+        for ru in reservation_usage
+    ]
+    return matched_instances, reservation_usage
+
+
+MATCHINGS = {
+    'exact': get_instance_matchings,
+    'size-flexible': get_size_flexible_instance_matchings,
+}
+
+
 def get_ec2_reservations(profiles, region):
     reservations = collections.defaultdict(int)
     for profile in profiles:
@@ -318,52 +534,44 @@ def get_ec2_instances(profiles, region):
     instances = collections.defaultdict(int)
     for profile in profiles:
         print('[{} - {}] Getting on-demand instances...'.format(profile, region))
-        ec2 = boto_session_getter(profile, region)
-        instance_types = get_ondemand_instance_types(ec2, profile)
+        instance_types = get_ondemand_instance_types(
+            get_profile_instances(profile, region), profile)
         for it in instance_types:
             instances[it] += 1
     return instances
 
 
-def get_ec2_offerings(instances, region, profiles):
-    with multiprocessing.pool.ThreadPool(processes=4) as pool:
+def get_ec2_offerings(instances, region):
+    offering_cache = OfferingCache(region)
+    with multiprocessing.pool.ThreadPool(processes=ratelimit.MAX_CONCURRENCY) as pool:
         offerings = collections.defaultdict(int)
         tasks = []
         print('[global - {}] Getting offerings for all instances...'.format(region))
         for instance, count in instances.items():
             ec2 = boto_session_getter(instance.profile, region)
             tasks.append({
-                'profile': [instance.profile],
-                'remaining_profiles': [p for p in profiles if p != instance.profile],
-                'instance_type': instance.instance_type,
+                'profile': instance.profile,
                 'instance_count': count,
                 'task': pool.apply_async(get_ec2_type_offerings,
-                                         [ec2, instance.instance_type]),
+                                         [ec2, instance.instance_type,
+                                          offering_cache]),
             })
         for i, task in zip(itertools.count(1), tasks):
-            if len(task['profile']) == 1:
-                print('[{} - {}] Getting offerings for instance {}/{}...'.format(
-                    task['profile'][0], region, i, len(instances)))
+            print('[{} - {}] Getting offerings for instance {}/{}...'.format(
+                task['profile'], region, i, len(instances)))
             offering = task['task'].get()
             if offering:
                 offerings[offering] += task['instance_count']
-            elif len(task['remaining_profiles']):
-                ec2 = boto_session_getter(task['remaining_profiles'][0], region)
-                new_task = task.copy()
-                new_task['task'] = pool.apply_async(get_ec2_type_offerings, [ec2, new_task['instance_type']])
-                new_task['profile'].append(new_task['remaining_profiles'][0])
-                new_task['remaining_profiles'].pop(0)
-                tasks.append(new_task)
+    offering_cache.save()
     return offerings
 
 
-def get_ec2_data(profiles, region):
+def get_ec2_data(profiles, region, matching=get_instance_matchings):
     reservations = get_ec2_reservations(profiles, region)
     instances = get_ec2_instances(profiles, region)
-    offerings = get_ec2_offerings(instances, region, profiles)
+    offerings = get_ec2_offerings(instances, region)
     print('[global - {}] Matching on-demand instances with reserved instances...'.format(region))
-    matched_instances, reservation_usage = get_instance_matchings(offerings,
-                                                                  reservations)
+    matched_instances, reservation_usage = matching(offerings, reservations)
     print('[global - {}] Done!'.format(region))
     return matched_instances, reservation_usage
 
@@ -422,15 +630,39 @@ def write_reservation_usage(f, reservation_usage, header=True):
         })
 
 
+def write_ec2_data(profiles, region, matching=get_instance_matchings):
+    matched_instances, reservation_usage = get_ec2_data(profiles, region,
+                                                        matching)
+    with open('{}/{}.csv'.format(DIR_INSTANCE_RESERVATION_USAGE, region),
+              'w') as f:
+        write_matched_instances(f, matched_instances)
+    with open('{}/{}.csv'.format(DIR_RESERVATION_USAGE, region), 'w') as f:
+        write_reservation_usage(f, reservation_usage)
+
+
+def write_regions_ec2_data(profiles, regions, workers=None,
+                           matching=get_instance_matchings):
+    """write_regions_ec2_data processes regions concurrently on a thread
+    pool. A region which fails is reported without stopping the others."""
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or len(regions)) as pool:
+        tasks = [
+            (region, pool.submit(write_ec2_data, profiles, region, matching))
+            for region in regions
+        ]
+        for region, task in tasks:
+            try:
+                task.result()
+            except Exception as e:
+                print('[global - {}] Error: {}'.format(region, e))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--region', help='aws region', required=True)
+    parser.add_argument('--region', help='aws regions', required=True, nargs='+')
     parser.add_argument('--profile', help='aws profile', required=True, nargs='+')
+    parser.add_argument('--region-workers', help='number of regions processed concurrently', type=int)
+    parser.add_argument('--matching', help='reserved instance matching engine', choices=MATCHINGS.keys(), default='exact')
     args = parser.parse_args()
-    matched_instances, reservation_usage = get_ec2_data(args.profile,
-                                                        args.region)
-    with open('{}/{}.csv'.format(DIR_INSTANCE_RESERVATION_USAGE, args.region),
-              'w') as f:
-        write_matched_instances(f, matched_instances)
-    with open('{}/{}.csv'.format(DIR_RESERVATION_USAGE, args.region), 'w') as f:
-        write_reservation_usage(f, reservation_usage)
+    write_regions_ec2_data(args.profile, args.region, args.region_workers,
+                           MATCHINGS[args.matching])
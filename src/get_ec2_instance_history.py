@@ -6,9 +6,8 @@ import functools
 import itertools
 import json
 
-import utils
+import usagecost
 
-USAGECOST_DIR='in/usagecost'
 OUT_PATH = 'out/instance-history.csv'
 USAGE = 'BoxUsage'
 
@@ -17,61 +16,50 @@ def updated(base, addend):
     base.update(addend)
     return base
 
-with utils.csv_folder(USAGECOST_DIR) as records:
-    box_usage_records = (
-        record
-        for record in records
-        if USAGE in record['lineItem/UsageType']
-    )
-    simplified_lineitems = (
-        (
-            record['product/instanceType'],
-            round(float(record['lineItem/UsageAmount'])) if record['lineItem/UsageAmount'] else 0,
-            record['lineItem/UsageStartDate'])
-        for record in box_usage_records
-    )
+class InstanceHistory:
+    """InstanceHistory counts the BoxUsage hours per usage start date and
+    instance type."""
+    columns = [
+        'lineItem/UsageType',
+        'lineItem/UsageStartDate',
+        'lineItem/UsageAmount',
+        'product/instanceType',
+    ]
 
-    histogram = {
-        date: updated(
-            collections.defaultdict(int),
-            {
-                instancetype: sum(
-                    lineitem[1] for lineitem in instancetype_lineitems
-                )
-                for instancetype, instancetype_lineitems in itertools.groupby(
-                    sorted(
-                        date_lineitems,
-                        key=lambda x: x[0],
-                    ),
-                    key=lambda x: x[0],
-                )
-            }
-        )
-        for date, date_lineitems in itertools.groupby(
-            sorted(
-                simplified_lineitems,
-                key=lambda x: x[2],
-            ),
-            key=lambda x: x[2],
+    def __init__(self):
+        self.usage = collections.defaultdict(int)
+
+    def add(self, record):
+        if USAGE in record['lineItem/UsageType']:
+            self.usage[(record['lineItem/UsageStartDate'], record['product/instanceType'])] += round(record['lineItem/UsageAmount'])
+
+    def merge(self, other):
+        for key, value in other.usage.items():
+            self.usage[key] += value
+
+    def write(self):
+        histogram = collections.defaultdict(dict)
+        for (date, instancetype), usage in self.usage.items():
+            histogram[date][instancetype] = usage
+        instance_types = sorted(
+            functools.reduce(
+                lambda x, y: x.union(y),
+                (
+                    date.keys()
+                    for date in histogram.values()
+                ),
+                frozenset(),
+            )
         )
-    }
 
-instance_types = sorted(
-    functools.reduce(
-        lambda x, y: x.union(y),
-        (
-            date.keys()
-            for date in histogram.values()
-        ),
-        frozenset(),
-    )
-)
+        with open(OUT_PATH, 'w') as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=['date', *instance_types])
+            writer.writeheader()
+            for date in sorted(histogram.keys()):
+                writer.writerow(updated(
+                    collections.defaultdict(int),
+                    { 'date': usagecost.format_timestamp(date), **histogram[date] }
+                ))
 
-with open(OUT_PATH, 'w') as outfile:
-    writer = csv.DictWriter(outfile, fieldnames=['date', *instance_types])
-    writer.writeheader()
-    for date in sorted(histogram.keys()):
-        writer.writerow(updated(
-            collections.defaultdict(int),
-            { 'date': date, **histogram[date] }
-        ))
+if __name__ == '__main__':
+    usagecost.run([InstanceHistory()])
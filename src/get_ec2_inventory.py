@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+
+import inventory
+import ratelimit
+from get_ec2_metadata import write_ec2_metadata
+
+
+def collect_region(session, account, region):
+    print('[{} - {}] Listing instances...'.format(account, region))
+    instances = inventory.describe_instances(ratelimit.client(session, 'ec2', region))
+    inventory.write_inventory(instances, account, region)
+    write_ec2_metadata(instances, account, region)
+    print('[{} - {}] Listed {} instances'.format(account, region, len(instances)))
+
+
+def collect(profiles, regions, workers=None):
+    """collect lists the instances of every profile in every region once,
+    caches them in the inventory and writes their metadata. Regions are
+    listed concurrently, and a profile or region which fails is reported
+    without stopping the others."""
+    accounts = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or len(regions)) as pool:
+        tasks = []
+        for profile in profiles:
+            try:
+                session = inventory.get_session(profile)
+                account = inventory.get_account(session)
+            except Exception as e:
+                print('[{}] Error: {}'.format(profile, e))
+                continue
+            accounts[profile] = account
+            tasks.extend(
+                (account, region, pool.submit(collect_region, session, account, region))
+                for region in regions
+            )
+        for account, region, task in tasks:
+            try:
+                task.result()
+            except Exception as e:
+                print('[{} - {}] Error: {}'.format(account, region, e))
+    inventory.write_accounts(accounts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--region', help='aws regions', required=True, nargs='+')
+    parser.add_argument('--profile', help='aws profile', required=True, nargs='+')
+    parser.add_argument('--region-workers', help='number of regions listed concurrently', type=int)
+    args = parser.parse_args()
+    collect(args.profile, args.region, args.region_workers)
@@ -1,20 +1,12 @@
 #!/usr/bin/env python3
 
 import boto3
-import itertools
-import collections
 import csv
-import sys
-import datetime
-import json
-import collections
-import re
-from dateutil.tz import tzutc
 
-DIR_INSTANCE_METADATA = 'out/instance-metadata'
+import inventory
+import ratelimit
 
-REGION = boto3._get_default_session().region_name
-ACCOUNT = boto3.client('sts').get_caller_identity()['Account']
+DIR_INSTANCE_METADATA = 'out/instance-metadata'
 
 
 def safe_list_get(l, idx, default):
@@ -24,24 +16,18 @@ def safe_list_get(l, idx, default):
         return default
 
 
-def get_ec2_metadata(ec2, region):
-    print("[{} - {}] Getting instances metadata...".format(ACCOUNT, REGION))
-    instances_pag = ec2.get_paginator('describe_instances')
-    metadata = [
+def get_ec2_metadata(instances):
+    return [
         {
             'instance_id': i.get('InstanceId', ''),
             'name': safe_list_get([v['Value'] for v in i.get('Tags', []) if v['Key'] == 'Name'], 0, ''),
             'ebs': ','.join([e.get('Ebs', {}).get('VolumeId', '') for e in i.get('BlockDeviceMappings', [])]),
         }
-        for p in instances_pag.paginate()
-        for r in p['Reservations']
-        for i in r['Instances']
+        for i in instances
     ]
-    print('[{} - {}] Done!'.format(ACCOUNT, REGION))
-    return metadata
 
 
-def write_instances_metadata(f, reservation_usage):
+def write_instances_metadata(f, metadata):
     writer = csv.DictWriter(f, fieldnames=[
         'instance_id',
         'name',
@@ -52,9 +38,17 @@ def write_instances_metadata(f, reservation_usage):
         writer.writerow(m)
 
 
+def write_ec2_metadata(instances, account, region):
+    print("[{} - {}] Writing instances metadata...".format(account, region))
+    with open('{}/{}.{}.csv'.format(DIR_INSTANCE_METADATA, account, region), 'w') as f:
+        write_instances_metadata(f, get_ec2_metadata(instances))
+
+
 if __name__ == '__main__':
-    ec2 = boto3.client('ec2')
-    metadata = get_ec2_metadata(
-        ec2, REGION)
-    with open('{}/{}.{}.csv'.format(DIR_INSTANCE_METADATA, ACCOUNT, REGION), 'w') as f:
-        write_instances_metadata(f, metadata)
+    session = boto3._get_default_session()
+    account = inventory.get_account(session)
+    region = session.region_name
+    instances = inventory.read_inventory(account, region)
+    if instances is None:
+        instances = inventory.describe_instances(ratelimit.client(session, 'ec2'))
+    write_ec2_metadata(instances, account, region)
@@ -1,44 +1,38 @@
 #!/usr/bin/env python3
 
+import argparse
 import collections
+import concurrent.futures
 import datetime
-import re
 import csv
+import json
+import os
+import warnings
 
 import boto3
+import numpy
 
-# Normalization factors can be found at
-# https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ri-modifying.html#ri-modification-instancemove
-# Authorized family can be found at
-# https://aws.amazon.com/ec2/pricing/on-demand
-INSTANCE_META = collections.OrderedDict([
-    ('nano'     , [1      , ["t2"]])                                                                                                 ,
-    ('micro'    , [2      , ["t2", "t1"]])                                                                                           ,
-    ('small'    , [1 * 4  , ["t2", "m1"]])                                                                                           ,
-    ('medium'   , [2 * 4  , ["t2", "m1", "m3", "c1"]])                                                                               ,
-    ('large'    , [4 * 4  , ["t2", "m5", "m4", "c5", "c4", "r4", "i3", "m1", "m3", "c3", "r3"]])                                     ,
-    ('xlarge'   , [8 * 4  , ["t2", "m5", "m4", "c5", "c4", "p2", "x1e", "r4", "i3", "d2", "m1", "m3", "c1", "c3", "m2", "r3", "i2"]]),
-    ('2xlarge'  , [16 * 4 , ["t2", "m5", "m4", "c5", "c4", "p3", "x1e", "r4", "i3", "h1", "d2", "m3", "c3", "g2", "m2", "r3", "i2"]]),
-    ('4xlarge'  , [32 * 4 , ["m5", "m4", "c5", "c4", "g3", "x1e", "r4", "i3", "h1", "d2", "c3", "m2", "r3", "i2"]])                  ,
-    ('8xlarge'  , [64 * 4 , ["c4", "p2", "p3", "g3", "x1e", "r4", "i3", "h1", "d2", "cc2", "c3", "g2", "cr1", "r3", "i2", "hs1"]])   ,
-    ('9xlarge'  , [72 * 4 , ["c5"]])                                                                                                 ,
-    ('10xlarge' , [80 * 4 , ["m4"]])                                                                                                 ,
-    ('12xlarge' , [96 * 4 , ["m5"]])                                                                                                 ,
-    ('16xlarge' , [128 * 4, ["m4", "p2", "p3", "g3", "x1", "x1e", "r4", "i3", "h1"]])                                                ,
-    ('18xlarge' , [144 * 4, ["c5"]])                                                                                                 ,
-    ('24xlarge' , [192 * 4, ["m5"]])                                                                                                 ,
-    ('32xlarge' , [256 * 4, ["x1", "x1e"]])                                                                                          ,
-])
+from instancesize import *
+import inventory
+import ratelimit
 
 TARGET_CPU_USAGE = 0.80
-CPU_USAGE_INTERVAL = datetime.timedelta(hours=24)
-CPU_USAGE_INTERVAL_SECOND = CPU_USAGE_INTERVAL.days * 24 * 3600 + CPU_USAGE_INTERVAL.seconds
+CPU_USAGE_WINDOW = datetime.timedelta(days=14)
+CPU_USAGE_PERCENTILE = 95.0
+CPU_USAGE_PERIOD = 3600
+# The latest hours may still be incomplete when fetched, so they are fetched
+# again on the next run.
+CPU_USAGE_REFETCH_HOURS = 2
 DIR_RECOMMENDATION = 'out/instance-size-recommendation'
+DIR_CPU_USAGE_CACHE = 'in/persistent/cpu-usage'
+METRIC_QUERIES_PER_CALL = 500
+CPU_USAGE_WORKERS = 4
 
 REGION=boto3._get_default_session().region_name
-ACCOUNT=boto3.client('sts').get_caller_identity()['Account']
+ACCOUNT=None
+
+CpuUsage = collections.namedtuple('CpuUsage', ['selected', 'p50', 'p95', 'max'])
 
-InstanceSize = collections.namedtuple('InstanceSize', ['family', 'size'])
 InstanceRecommendation = collections.namedtuple('InstanceRecommendation', [
     'account',
     'id',
@@ -46,6 +40,9 @@ InstanceRecommendation = collections.namedtuple('InstanceRecommendation', [
     'size',
     'lifecycle',
     'cpu_usage',
+    'cpu_p50',
+    'cpu_p95',
+    'cpu_max',
     'recommendation',
     'saving',
     'reason',
@@ -60,33 +57,21 @@ def next_or(it, default):
 def next_or_none(it):
     return next_or(it, None)
 
-_str_to_instance_size_re = re.compile(r'([a-z]+[0-9])\.(nano|micro|small|medium|(?:[0-9]*x?large))')
-def str_to_instance_size(s):
-    m = _str_to_instance_size_re.match(s)
-    if m:
-        return InstanceSize(
-            family=m.group(1),
-            size=m.group(2),
-        )
-
-def instance_size_to_str(instance_size):
-    return '{}.{}'.format(*instance_size)
-
 def recommended_size(instance_type, cpu_usage):
     current_norm_factor = INSTANCE_META[instance_type.size][0]
     cpu_delta = cpu_usage / TARGET_CPU_USAGE
     target_norm_factor = cpu_delta * current_norm_factor
-    matching_norm_factor = next(size for size, meta in INSTANCE_META.items() if meta[0] >= target_norm_factor and instance_type.family in meta[1])
+    matching_norm_factor = next_or((size for size, meta in INSTANCE_META.items() if meta[0] >= target_norm_factor and instance_type.family in meta[1]), instance_type.size)
     return matching_norm_factor
 
-def get_reason(cpu_usage, current_size, recommendation):
+def get_reason(cpu_usage, current_size, recommendation, percentile):
     if cpu_usage is None:
         return 'insufficient_data'
-    elif cpu_usage > 0.80:
-        return 'High CPU usage average: {0:.3f}%'.format(cpu_usage*100)
+    elif cpu_usage > TARGET_CPU_USAGE:
+        return 'High CPU usage (p{0:g}): {1:.3f}%'.format(percentile, cpu_usage*100)
     elif current_size == recommendation:
-        return 'Optimal CPU usage average'
-    return 'Low CPU usage average: {0:.3f}%'.format(cpu_usage*100)
+        return 'Optimal CPU usage (p{0:g})'.format(percentile)
+    return 'Low CPU usage (p{0:g}): {1:.3f}%'.format(percentile, cpu_usage*100)
 
 def get_saving(cpu_usage, current_size, recommendation):
     current_norm_factor = INSTANCE_META[current_size][0]
@@ -97,54 +82,157 @@ def get_saving(cpu_usage, current_size, recommendation):
         return '{0:.1f}%'.format(100 - ((recommended_norm_factor * 100) / current_norm_factor))
 
 
-def get_cpu_usage(cloudwatch, now, instance_id):
-    usage_statistics = cloudwatch.get_metric_statistics(
-        Namespace='AWS/EC2',
-        MetricName='CPUUtilization',
-        Dimensions=[
-            { 'Name': 'InstanceId', 'Value': instance_id },
-        ],
-        StartTime=now - CPU_USAGE_INTERVAL,
-        EndTime=now,
-        Period=CPU_USAGE_INTERVAL_SECOND,
-        Statistics=['Average']
-    )
+def cpu_usage_query(query_id, instance_id):
+    return {
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {
+                'Namespace': 'AWS/EC2',
+                'MetricName': 'CPUUtilization',
+                'Dimensions': [
+                    { 'Name': 'InstanceId', 'Value': instance_id },
+                ],
+            },
+            'Period': CPU_USAGE_PERIOD,
+            'Stat': 'Average',
+        },
+    }
+
+def get_cpu_usage_batch(cloudwatch, start, end, instance_ids):
+    """get_cpu_usage_batch fetches the hourly CPU usage of up to
+    METRIC_QUERIES_PER_CALL instances between two timestamps with
+    GetMetricData, following its pages, and returns it per instance id as
+    percentages per hour timestamp."""
+    queries = [
+        cpu_usage_query('i{}'.format(i), instance_id)
+        for i, instance_id in enumerate(instance_ids)
+    ]
+    usages = {query['Id']: {} for query in queries}
+    for page in cloudwatch.paginate(
+            'get_metric_data',
+            MetricDataQueries=queries,
+            StartTime=datetime.datetime.fromtimestamp(start, datetime.timezone.utc),
+            EndTime=datetime.datetime.fromtimestamp(end, datetime.timezone.utc),
+        ):
+        for result in page['MetricDataResults']:
+            for timestamp, value in zip(result['Timestamps'], result['Values']):
+                usages[result['Id']][int(timestamp.timestamp())] = value
+    return {
+        instance_id: usages[query['Id']]
+        for instance_id, query in zip(instance_ids, queries)
+    }
+
+def cpu_usage_cache_path():
+    return '{}/{}.{}.json'.format(DIR_CPU_USAGE_CACHE, ACCOUNT, REGION)
+
+def read_cpu_usage_cache():
     try:
-        return usage_statistics['Datapoints'][0]['Average'] / 100
-    except IndexError:
-        return None
-
-def get_recommendation(instance):
+        with open(cpu_usage_cache_path()) as f:
+            return {
+                instance_id: {int(hour): value for hour, value in usage.items()}
+                for instance_id, usage in json.load(f).items()
+            }
+    except FileNotFoundError:
+        return {}
+
+def write_cpu_usage_cache(history):
+    os.makedirs(DIR_CPU_USAGE_CACHE, exist_ok=True)
+    tmppath = cpu_usage_cache_path() + '.tmp'
+    with open(tmppath, 'w') as f:
+        json.dump(history, f, separators=(',', ':'))
+    os.replace(tmppath, cpu_usage_cache_path())
+
+def get_cpu_usage_history(cloudwatch, start, end, instance_ids):
+    """get_cpu_usage_history returns the hourly CPU usage of instances
+    between two timestamps. Hours cached by previous runs are not fetched
+    again, except the latest ones, and instances are fetched in batches
+    grouped by the first hour they miss, run concurrently."""
+    cached = read_cpu_usage_cache()
+    history = {
+        instance_id: {
+            hour: value
+            for hour, value in cached.get(instance_id, {}).items()
+            if start <= hour < end
+        }
+        for instance_id in instance_ids
+    }
+    instances_by_start = collections.defaultdict(list)
+    for instance_id, usage in history.items():
+        if usage:
+            fetch_start = max(start, max(usage) - (CPU_USAGE_REFETCH_HOURS - 1) * CPU_USAGE_PERIOD)
+        else:
+            fetch_start = start
+        instances_by_start[fetch_start].append(instance_id)
+    batches = [
+        (fetch_start, ids[i:i + METRIC_QUERIES_PER_CALL])
+        for fetch_start, ids in instances_by_start.items()
+        for i in range(0, len(ids), METRIC_QUERIES_PER_CALL)
+    ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=CPU_USAGE_WORKERS) as pool:
+        for usages in pool.map(lambda batch: get_cpu_usage_batch(cloudwatch, batch[0], end, batch[1]), batches):
+            for instance_id, usage in usages.items():
+                history[instance_id].update(usage)
+    write_cpu_usage_cache(history)
+    return history
+
+def get_cpu_usages(history, start, end, percentile):
+    """get_cpu_usages computes the median, 95th percentile, maximum and
+    selected percentile of the hourly CPU usage of each instance at once on
+    an instances by hours matrix, as ratios. Instances without datapoints
+    get None."""
+    instance_ids = list(history)
+    hours = (end - start) // CPU_USAGE_PERIOD
+    usages = numpy.full((len(instance_ids), hours), numpy.nan)
+    for row, instance_id in enumerate(instance_ids):
+        usage = history[instance_id]
+        if usage:
+            columns = (numpy.fromiter(usage.keys(), dtype=numpy.int64, count=len(usage)) - start) // CPU_USAGE_PERIOD
+            usages[row, columns] = numpy.fromiter(usage.values(), dtype=float, count=len(usage))
+    with warnings.catch_warnings():
+        # instances without datapoints have all-NaN rows
+        warnings.simplefilter('ignore', RuntimeWarning)
+        selected, p50, p95 = numpy.nanpercentile(usages, [percentile, 50, 95], axis=1) / 100
+        maximum = numpy.nanmax(usages, axis=1) / 100 if hours else numpy.full(len(instance_ids), numpy.nan)
+    return {
+        instance_id: CpuUsage(*values) if not numpy.isnan(values[0]) else None
+        for instance_id, values in zip(instance_ids, zip(selected.tolist(), p50.tolist(), p95.tolist(), maximum.tolist()))
+    }
+
+def get_recommendation(instance, cpu_usage, percentile):
         instance_type_str = instance['InstanceType']
         instance_type = str_to_instance_size(instance_type_str)
         instance_id = instance['InstanceId']
         instance_name = next_or((tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == 'Name'), '')
         instance_lifecycle = instance.get('InstanceLifecycle', 'ondemand')
-        cpu_usage = get_cpu_usage(cloudwatch, now, instance_id)
-        recommendation = recommended_size(instance_type, cpu_usage) if cpu_usage is not None else 'insufficient_data'
-        reason = get_reason(cpu_usage, instance_type.size, recommendation)
-        saving = get_saving(cpu_usage, instance_type.size, recommendation)
+        selected = cpu_usage.selected if cpu_usage is not None else None
+        recommendation = recommended_size(instance_type, selected) if selected is not None else 'insufficient_data'
+        reason = get_reason(selected, instance_type.size, recommendation, percentile)
+        saving = get_saving(selected, instance_type.size, recommendation)
         return InstanceRecommendation(
             id=instance_id,
             name=instance_name,
             size=instance_type_str,
             lifecycle=instance_lifecycle,
-            cpu_usage=cpu_usage or "",
+            cpu_usage=selected or "",
+            cpu_p50=cpu_usage.p50 if cpu_usage is not None else "",
+            cpu_p95=cpu_usage.p95 if cpu_usage is not None else "",
+            cpu_max=cpu_usage.max if cpu_usage is not None else "",
             recommendation=recommendation,
             reason=reason,
             saving=saving,
             account=ACCOUNT,
         )
 
-def main(ec2, cloudwatch, now):
-    instances = (
-        instance
-        for page in ec2.get_paginator('describe_instances').paginate()
-        for reservation in page['Reservations']
-        for instance in reservation['Instances']
-    )
+def main(ec2, cloudwatch, now, window=CPU_USAGE_WINDOW, percentile=CPU_USAGE_PERCENTILE):
+    instances = inventory.read_inventory(ACCOUNT, REGION)
+    if instances is None:
+        instances = inventory.describe_instances(ec2)
+    end = int(now.timestamp()) // CPU_USAGE_PERIOD * CPU_USAGE_PERIOD
+    start = end - int(window.total_seconds()) // CPU_USAGE_PERIOD * CPU_USAGE_PERIOD
+    history = get_cpu_usage_history(cloudwatch, start, end, [instance['InstanceId'] for instance in instances])
+    cpu_usages = get_cpu_usages(history, start, end, percentile)
     recommendations = (
-        get_recommendation(instance)
+        get_recommendation(instance, cpu_usages[instance['InstanceId']], percentile)
         for instance in instances
     )
     recommendations = sorted(recommendations, key=lambda r: (r.name, r.size))
@@ -155,7 +243,13 @@ def main(ec2, cloudwatch, now):
             writer.writerow(recommendation)
 
 if __name__ == '__main__':
-    ec2 = boto3.client('ec2')
-    cloudwatch = boto3.client('cloudwatch')
-    now = datetime.datetime.now()
-    main(ec2, cloudwatch, now)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--window-days', help='days of CPU usage history to base recommendations on', type=int, default=CPU_USAGE_WINDOW.days)
+    parser.add_argument('--account', help='aws account of the credentials, to skip looking it up')
+    parser.add_argument('--percentile', help='percentile of the hourly CPU usage compared to the target usage', type=float, default=CPU_USAGE_PERCENTILE)
+    args = parser.parse_args()
+    ACCOUNT = args.account or inventory.get_account(boto3._get_default_session())
+    ec2 = ratelimit.client(boto3._get_default_session(), 'ec2')
+    cloudwatch = ratelimit.client(boto3._get_default_session(), 'cloudwatch')
+    now = datetime.datetime.now(datetime.timezone.utc)
+    main(ec2, cloudwatch, now, datetime.timedelta(days=args.window_days), args.percentile)
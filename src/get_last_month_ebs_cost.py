@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import calendar
 import csv
 from datetime import datetime
 from collections import defaultdict
@@ -7,60 +8,87 @@ import dateutil.relativedelta
 import json
 import re
 
+import usagecost
 import utils
 
-USAGECOST_DIR='in/usagecost'
 METADATA_DIR='out/instance-metadata'
 OUT_PATH_EBS = 'out/last-month/ebs.csv'
 OUT_PATH_SNAPSHOTS = 'out/last-month/snapshots.csv'
 
 BEGIN_LAST_MONTH = (datetime.now() + dateutil.relativedelta.relativedelta(months=-1)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
 END_LAST_MONTH = (BEGIN_LAST_MONTH + dateutil.relativedelta.relativedelta(months=1, days=-1)).replace(hour=23, minute=59, second=59, microsecond=999999)
+BEGIN_LAST_MONTH_TIMESTAMP = calendar.timegm(BEGIN_LAST_MONTH.timetuple())
+END_LAST_MONTH_TIMESTAMP = calendar.timegm(END_LAST_MONTH.timetuple())
 
-with utils.csv_folder(METADATA_DIR) as records:
-    ebs_match = re.compile(r"((vol-[0-9a-fA-F]*),?)*")
-    ebs_links = defaultdict(lambda: ("",""))
-    for record in records:
-        for ebs in ebs_match.match(record['ebs']).group(0).split(','):
-            ebs_links[ebs] = (record['instance_id'], record['name'])
+class LastMonthEbsUsage:
+    """LastMonthEbsUsage aggregates last month's EBS volume and snapshot costs
+    per resource."""
+    columns = [
+        'lineItem/ResourceId',
+        'lineItem/UsageStartDate',
+        'lineItem/UsageType',
+        'lineItem/UsageAccountId',
+        'lineItem/UnblendedCost',
+        'product/region',
+    ]
 
-with utils.csv_folder(USAGECOST_DIR) as records:
-    resource_id_missing = False
-    ebs_usage_records = defaultdict(float)
-    snapshot_usage_records = defaultdict(float)
-    for record in records:
+    def __init__(self):
+        self.resource_id_missing = False
+        self.ebs_usage_records = defaultdict(float)
+        self.snapshot_usage_records = defaultdict(float)
+
+    def add(self, record):
         if 'lineItem/ResourceId' not in record:
-            if resource_id_missing == False:
+            if self.resource_id_missing == False:
                 print("Error: the billing report does not export the ResourceId")
-                resource_id_missing = True
-            continue
+                self.resource_id_missing = True
+            return
         if 'EBS' in record['lineItem/UsageType'] and 'EBSOptimized' not in record['lineItem/UsageType']:
-            usage_start_date = datetime.strptime(record['lineItem/UsageStartDate'], '%Y-%m-%dT%H:%M:%SZ')
-            if usage_start_date >= BEGIN_LAST_MONTH and usage_start_date <= END_LAST_MONTH:
+            usage_start_date = record['lineItem/UsageStartDate']
+            if usage_start_date >= BEGIN_LAST_MONTH_TIMESTAMP and usage_start_date <= END_LAST_MONTH_TIMESTAMP:
                 if 'Snapshot' not in record['lineItem/UsageType']:
-                    ebs_usage_records[(record['lineItem/UsageAccountId'], record['lineItem/ResourceId'], record['product/region'])] += float(record['lineItem/UnblendedCost'])
+                    self.ebs_usage_records[(record['lineItem/UsageAccountId'], record['lineItem/ResourceId'], record['product/region'])] += record['lineItem/UnblendedCost']
                 elif 'Snapshot' in record['lineItem/UsageType']:
-                    snapshot_usage_records[(record['lineItem/UsageAccountId'], record['lineItem/ResourceId'])] += float(record['lineItem/UnblendedCost'])
+                    self.snapshot_usage_records[(record['lineItem/UsageAccountId'], record['lineItem/ResourceId'])] += record['lineItem/UnblendedCost']
+
+    def merge(self, other):
+        self.resource_id_missing = self.resource_id_missing or other.resource_id_missing
+        for key, value in other.ebs_usage_records.items():
+            self.ebs_usage_records[key] += value
+        for key, value in other.snapshot_usage_records.items():
+            self.snapshot_usage_records[key] += value
+
+    def write(self):
+        with utils.csv_folder(METADATA_DIR) as records:
+            ebs_match = re.compile(r"((vol-[0-9a-fA-F]*),?)*")
+            ebs_links = defaultdict(lambda: ("",""))
+            for record in records:
+                for ebs in ebs_match.match(record['ebs']).group(0).split(','):
+                    ebs_links[ebs] = (record['instance_id'], record['name'])
+        ebs_usage_records = self.ebs_usage_records
+        snapshot_usage_records = self.snapshot_usage_records
+        with open(OUT_PATH_EBS, 'w') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(['Account', 'ResourceId', 'Region', 'Cost', 'InstanceId', 'InstanceName'])
+            for ebs in sorted(ebs_usage_records.keys(), key=lambda tup: ebs_usage_records[tup], reverse=True):
+                writer.writerow([
+                    ebs[0],
+                    ebs[1],
+                    ebs[2],
+                    repr(ebs_usage_records[ebs]),
+                    ebs_links[ebs[1]][0],
+                    ebs_links[ebs[1]][1],
+                ])
 
-with open(OUT_PATH_EBS, 'w') as outfile:
-    writer = csv.writer(outfile)
-    writer.writerow(['Account', 'ResourceId', 'Region', 'Cost', 'InstanceId', 'InstanceName'])
-    for ebs in sorted(ebs_usage_records.keys(), key=lambda tup: ebs_usage_records[tup], reverse=True):
-        writer.writerow([
-            ebs[0],
-            ebs[1],
-            ebs[2],
-            repr(ebs_usage_records[ebs]),
-            ebs_links[ebs[1]][0],
-            ebs_links[ebs[1]][1],
-        ])
+        with open(OUT_PATH_SNAPSHOTS, 'w') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(['Account', 'ResourceId', 'Cost'])
+            for rid in sorted(snapshot_usage_records.keys(), key=lambda rid: snapshot_usage_records[rid], reverse=True):
+                writer.writerow([
+                    rid[0],
+                    rid[1],
+                    repr(snapshot_usage_records[rid]),
+                ])
 
-with open(OUT_PATH_SNAPSHOTS, 'w') as outfile:
-    writer = csv.writer(outfile)
-    writer.writerow(['Account', 'ResourceId', 'Cost'])
-    for rid in sorted(snapshot_usage_records.keys(), key=lambda rid: snapshot_usage_records[rid], reverse=True):
-        writer.writerow([
-            rid[0],
-            rid[1],
-            repr(snapshot_usage_records[rid]),
-        ])
+if __name__ == '__main__':
+    usagecost.run([LastMonthEbsUsage()])
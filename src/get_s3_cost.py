@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
 
+import calendar
 import csv
 from datetime import datetime
 from collections import defaultdict
 import dateutil.relativedelta
 
-import utils
+import usagecost
 
-USAGECOST_DIR='in/usagecost'
 OUT_PATH_S3 = 'out/s3/current_usage.csv'
 
 BEGIN_LAST_MONTH = (datetime.now() + dateutil.relativedelta.relativedelta(months=-1)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
 BEGIN_CURRENT_MONTH = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+BEGIN_LAST_MONTH_TIMESTAMP = calendar.timegm(BEGIN_LAST_MONTH.timetuple())
+BEGIN_CURRENT_MONTH_TIMESTAMP = calendar.timegm(BEGIN_CURRENT_MONTH.timetuple())
+
+def new_bucket_usage():
+    return dict(usage_gb_month=0.0, storage_cost=0.0, bandwidth_cost=0.0, requests_cost=0.0, last_month_cost=0.0)
 
 def get_simplified_cost_name(record):
     if 'TimedStorage' in record.get('lineItem/UsageType', ''):
@@ -22,37 +27,62 @@ def get_simplified_cost_name(record):
         return 'requests_cost'
     return None
 
-with utils.csv_folder(USAGECOST_DIR) as records:
-    resource_id_missing = False
-    s3_usage = defaultdict(lambda:dict(usage_gb_month=0.0, storage_cost=0.0, bandwidth_cost=0.0, requests_cost=0.0, last_month_cost=0.0))
-    for record in records:
+class S3Usage:
+    """S3Usage aggregates the current and last month's S3 costs per
+    bucket."""
+    columns = [
+        'lineItem/ResourceId',
+        'lineItem/ProductCode',
+        'lineItem/UsageStartDate',
+        'lineItem/UsageType',
+        'lineItem/UsageAmount',
+        'lineItem/UnblendedCost',
+        'product/servicecode',
+    ]
+
+    def __init__(self):
+        self.resource_id_missing = False
+        self.s3_usage = defaultdict(new_bucket_usage)
+
+    def add(self, record):
         if 'lineItem/ResourceId' not in record:
-            if resource_id_missing == False:
+            if self.resource_id_missing == False:
                 print("Error: the billing report does not export the ResourceId")
-                resource_id_missing = True
-            continue
+                self.resource_id_missing = True
+            return
         if record['lineItem/ProductCode'] == 'AmazonS3':
-            usage_start_date = datetime.strptime(record['lineItem/UsageStartDate'], '%Y-%m-%dT%H:%M:%SZ')
-            if usage_start_date >= BEGIN_LAST_MONTH:
+            usage_start_date = record['lineItem/UsageStartDate']
+            if usage_start_date >= BEGIN_LAST_MONTH_TIMESTAMP:
                 simplified_cost_name = get_simplified_cost_name(record)
                 if simplified_cost_name is not None:
-                    if usage_start_date >= BEGIN_CURRENT_MONTH:
-                        s3_usage[record.get('lineItem/ResourceId', '')][simplified_cost_name] += float(record['lineItem/UnblendedCost'])
+                    if usage_start_date >= BEGIN_CURRENT_MONTH_TIMESTAMP:
+                        self.s3_usage[record.get('lineItem/ResourceId', '')][simplified_cost_name] += record['lineItem/UnblendedCost']
                         if simplified_cost_name == 'storage_cost':
-                            s3_usage[record.get('lineItem/ResourceId', '')]['usage_gb_month'] += float(record['lineItem/UsageAmount'])
+                            self.s3_usage[record.get('lineItem/ResourceId', '')]['usage_gb_month'] += record['lineItem/UsageAmount']
                     else:
-                        s3_usage[record.get('lineItem/ResourceId', '')]['last_month_cost'] += float(record['lineItem/UnblendedCost'])
-
-with open(OUT_PATH_S3, 'w') as outfile:
-    writer = csv.writer(outfile)
-    writer.writerow(['Bucket', 'Usage-GB-Month', 'StorageCost', 'BandwidthCost', 'RequestsCost', 'CurrentTotal', 'LastMonthTotal'])
-    for bucket in sorted(list(s3_usage.keys()), key=lambda resid: s3_usage[resid]['last_month_cost'], reverse=True):
-        writer.writerow([
-            bucket,
-            s3_usage[bucket]['usage_gb_month'],
-            s3_usage[bucket]['storage_cost'],
-            s3_usage[bucket]['bandwidth_cost'],
-            s3_usage[bucket]['requests_cost'],
-            s3_usage[bucket]['storage_cost'] + s3_usage[bucket]['bandwidth_cost'] + s3_usage[bucket]['requests_cost'],
-            s3_usage[bucket]['last_month_cost'],
-        ])
+                        self.s3_usage[record.get('lineItem/ResourceId', '')]['last_month_cost'] += record['lineItem/UnblendedCost']
+
+    def merge(self, other):
+        self.resource_id_missing = self.resource_id_missing or other.resource_id_missing
+        for bucket, usage in other.s3_usage.items():
+            for key, value in usage.items():
+                self.s3_usage[bucket][key] += value
+
+    def write(self):
+        s3_usage = self.s3_usage
+        with open(OUT_PATH_S3, 'w') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(['Bucket', 'Usage-GB-Month', 'StorageCost', 'BandwidthCost', 'RequestsCost', 'CurrentTotal', 'LastMonthTotal'])
+            for bucket in sorted(list(s3_usage.keys()), key=lambda resid: s3_usage[resid]['last_month_cost'], reverse=True):
+                writer.writerow([
+                    bucket,
+                    s3_usage[bucket]['usage_gb_month'],
+                    s3_usage[bucket]['storage_cost'],
+                    s3_usage[bucket]['bandwidth_cost'],
+                    s3_usage[bucket]['requests_cost'],
+                    s3_usage[bucket]['storage_cost'] + s3_usage[bucket]['bandwidth_cost'] + s3_usage[bucket]['requests_cost'],
+                    s3_usage[bucket]['last_month_cost'],
+                ])
+
+if __name__ == '__main__':
+    usagecost.run([S3Usage()])
@@ -0,0 +1,45 @@
+import collections
+import re
+
+# Normalization factors can be found at
+# https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ri-modifying.html#ri-modification-instancemove
+# Authorized family can be found at
+# https://aws.amazon.com/ec2/pricing/on-demand
+INSTANCE_META = collections.OrderedDict([
+    ('nano'     , [1      , ["t2"]])                                                                                                 ,
+    ('micro'    , [2      , ["t2", "t1"]])                                                                                           ,
+    ('small'    , [1 * 4  , ["t2", "m1"]])                                                                                           ,
+    ('medium'   , [2 * 4  , ["t2", "m1", "m3", "c1"]])                                                                               ,
+    ('large'    , [4 * 4  , ["t2", "m5", "m4", "c5", "c4", "r4", "i3", "m1", "m3", "c3", "r3"]])                                     ,
+    ('xlarge'   , [8 * 4  , ["t2", "m5", "m4", "c5", "c4", "p2", "x1e", "r4", "i3", "d2", "m1", "m3", "c1", "c3", "m2", "r3", "i2"]]),
+    ('2xlarge'  , [16 * 4 , ["t2", "m5", "m4", "c5", "c4", "p3", "x1e", "r4", "i3", "h1", "d2", "m3", "c3", "g2", "m2", "r3", "i2"]]),
+    ('4xlarge'  , [32 * 4 , ["m5", "m4", "c5", "c4", "g3", "x1e", "r4", "i3", "h1", "d2", "c3", "m2", "r3", "i2"]])                  ,
+    ('8xlarge'  , [64 * 4 , ["c4", "p2", "p3", "g3", "x1e", "r4", "i3", "h1", "d2", "cc2", "c3", "g2", "cr1", "r3", "i2", "hs1"]])   ,
+    ('9xlarge'  , [72 * 4 , ["c5"]])                                                                                                 ,
+    ('10xlarge' , [80 * 4 , ["m4"]])                                                                                                 ,
+    ('12xlarge' , [96 * 4 , ["m5"]])                                                                                                 ,
+    ('16xlarge' , [128 * 4, ["m4", "p2", "p3", "g3", "x1", "x1e", "r4", "i3", "h1"]])                                                ,
+    ('18xlarge' , [144 * 4, ["c5"]])                                                                                                 ,
+    ('24xlarge' , [192 * 4, ["m5"]])                                                                                                 ,
+    ('32xlarge' , [256 * 4, ["x1", "x1e"]])                                                                                          ,
+])
+
+InstanceSize = collections.namedtuple('InstanceSize', ['family', 'size'])
+
+_str_to_instance_size_re = re.compile(r'([a-z]+[0-9])\.(nano|micro|small|medium|(?:[0-9]*x?large))')
+def str_to_instance_size(s):
+    m = _str_to_instance_size_re.match(s)
+    if m:
+        return InstanceSize(
+            family=m.group(1),
+            size=m.group(2),
+        )
+
+def instance_size_to_str(instance_size):
+    return '{}.{}'.format(*instance_size)
+
+def normalization_factor(size):
+    """normalization_factor returns the normalization factor of an instance
+    size such as 'xlarge', or None when it is unknown."""
+    meta = INSTANCE_META.get(size)
+    return meta[0] if meta else None
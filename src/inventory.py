@@ -0,0 +1,58 @@
+import json
+import os
+
+import boto3
+
+DIR_INVENTORY = 'out/instance-inventory'
+FIL_ACCOUNTS = os.path.join(DIR_INVENTORY, 'accounts.json')
+
+def get_session(profile):
+    """get_session returns the boto3 session of a profile. The 'env' profile
+    stands for the credentials found in the environment."""
+    if profile != 'env':
+        return boto3.Session(profile_name=profile)
+    return boto3.Session()
+
+def get_account(session):
+    return session.client('sts').get_caller_identity()['Account']
+
+def describe_instances(ec2):
+    """describe_instances lists all the instances of a throttled EC2
+    client's region in a single pagination."""
+    return [
+        instance
+        for page in ec2.paginate('describe_instances')
+        for reservation in page['Reservations']
+        for instance in reservation['Instances']
+    ]
+
+def inventory_path(account, region):
+    return os.path.join(DIR_INVENTORY, '{}.{}.json'.format(account, region))
+
+def write_inventory(instances, account, region):
+    os.makedirs(DIR_INVENTORY, exist_ok=True)
+    with open(inventory_path(account, region), 'w') as f:
+        json.dump(instances, f, default=str)
+
+def read_inventory(account, region):
+    """read_inventory returns the instances collected for an account in a
+    region by get_ec2_inventory.py, or None when they were not collected."""
+    try:
+        with open(inventory_path(account, region)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_accounts(accounts):
+    os.makedirs(DIR_INVENTORY, exist_ok=True)
+    with open(FIL_ACCOUNTS, 'w') as f:
+        json.dump(accounts, f)
+
+def read_accounts():
+    """read_accounts returns the account of each profile the inventory was
+    collected for."""
+    try:
+        with open(FIL_ACCOUNTS) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
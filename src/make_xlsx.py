@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import collections
+import concurrent.futures
 import csv
 import itertools
 import json
@@ -9,6 +10,7 @@ import os
 import pprint
 from collections import defaultdict
 import xlsxwriter
+from xlsxwriter.utility import xl_cell_to_rowcol
 from datetime import datetime
 import dateutil.relativedelta
 import sys
@@ -55,38 +57,77 @@ COLOR_RED_FG = "#cc0000"
 COLOR_GREEN_BG = "#ccffcc"
 COLOR_GREEN_FG = "#006600"
 
+FORMAT_VALUE = {"align": "center", "valign": "vcenter", "border": 1}
+FORMAT_HEADER = dict(FORMAT_VALUE, bold=True)
+FORMAT_CURRENCY = dict(FORMAT_VALUE, num_format=NUMFORMAT_CURRENCY)
+FORMAT_PERCENT = dict(FORMAT_VALUE, num_format=NUMFORMAT_PERCENT)
+FORMAT_GREEN = {"font_color": COLOR_GREEN_FG, "bg_color": COLOR_GREEN_BG}
+FORMAT_RED = {"font_color": COLOR_RED_FG, "bg_color": COLOR_RED_BG}
+
+
+class FormatRegistry:
+    """FormatRegistry holds the formats of a workbook. get() adds a format to
+    the workbook the first time its properties are asked for, and returns
+    that same format afterwards, so that all sheets share a handful of
+    formats."""
+    def __init__(self, workbook):
+        self._workbook = workbook
+        self._formats = {}
+
+    def get(self, properties):
+        key = tuple(sorted(properties.items()))
+        if key not in self._formats:
+            self._formats[key] = self._workbook.add_format(properties)
+        return self._formats[key]
+
 
 def _with_trailing(it, trail):
     return itertools.chain(it, itertools.repeat(trail))
 
 
-def gen_reserved_summary(workbook, header_format, val_format):
+def _cell_range(cell_range):
+    if isinstance(cell_range, str):
+        first, _, last = cell_range.partition(':')
+        return xl_cell_to_rowcol(first) + xl_cell_to_rowcol(last or first)
+    elif len(cell_range) == 2:
+        return tuple(cell_range) * 2
+    else:
+        return tuple(cell_range)
+
+
+def write_header(worksheet, header, header_format):
+    """write_header writes the header of a worksheet, given as (range, label)
+    pairs, row by row as constant_memory mode requires. Ranges of several cells
+    are merged, and the cells of a merge below its first row are written as
+    blanks along with the rest of their row."""
+    ranges = [_cell_range(cell_range) + (label,) for cell_range, label in header]
+    for row in range(min(r[0] for r in ranges), max(r[2] for r in ranges) + 1):
+        for first_row, first_col, last_row, last_col, label in ranges:
+            if not first_row <= row <= last_row:
+                continue
+            if row == first_row and (first_row, first_col) != (last_row, last_col):
+                # Without data nor format merge_range writes no cell, which
+                # would otherwise flush the first row of the merge.
+                worksheet.merge_range(first_row, first_col, last_row, last_col, None)
+            for col in range(first_col, last_col + 1):
+                if (row, col) == (first_row, first_col):
+                    worksheet.write(row, col, label, header_format)
+                else:
+                    worksheet.write_blank(row, col, None, header_format)
+
+
+def gen_reserved_summary(workbook, formats):
+    header_format = formats.get(FORMAT_HEADER)
+    val_format = formats.get(FORMAT_VALUE)
     with utils.csv_folder(IN_INSTANCE_RESERVATION_USAGE_DIR) as records:
         worksheet = workbook.add_worksheet("Reserved instance summary")
 
         worksheet.freeze_panes(2, 0)
         worksheet.set_column("A:O", 15)
-        worksheet.merge_range("A1:D1", "Reservation", header_format)
-        worksheet.merge_range("E1:F1", "Count", header_format)
-        worksheet.merge_range("G1:I1", "Cost per instance", header_format)
-        worksheet.merge_range("J1:L1", "Total monthly cost", header_format)
-        worksheet.merge_range("M1:N1", "Savings over on demand", header_format)
-
-        green_format = workbook.add_format()
-        green_format.set_color(COLOR_GREEN_FG)
-        green_format.set_bg_color(COLOR_GREEN_BG)
-
-        cur_format = workbook.add_format()
-        cur_format.set_align("center")
-        cur_format.set_align("vcenter")
-        cur_format.set_border()
-        cur_format.set_num_format(NUMFORMAT_CURRENCY)
-
-        per_format = workbook.add_format()
-        per_format.set_align("center")
-        per_format.set_align("vcenter")
-        per_format.set_border()
-        per_format.set_num_format(NUMFORMAT_PERCENT)
+
+        green_format = formats.get(FORMAT_GREEN)
+        cur_format = formats.get(FORMAT_CURRENCY)
+        per_format = formats.get(FORMAT_PERCENT)
 
         refs = {
             "instance_type": [0, "Instance type", str, val_format],
@@ -104,9 +145,16 @@ def gen_reserved_summary(workbook, header_format, val_format):
             "savings_reserved_worst": [12, "Worst reserved", float, per_format],
             "savings_reserved_best": [13, "Best reserved", float, per_format],
         }
-        for v in refs.values():
-            worksheet.write(1, v[0], v[1], header_format)
+        write_header(worksheet, [
+            ("A1:D1", "Reservation"),
+            ("E1:F1", "Count"),
+            ("G1:I1", "Cost per instance"),
+            ("J1:L1", "Total monthly cost"),
+            ("M1:N1", "Savings over on demand"),
+        ] + [((1, v[0]), v[1]) for v in refs.values()], header_format)
+        last_row = 1
         for i, line in zip(itertools.count(2), records):
+            last_row = i
             for h, v in line.items():
                 worksheet.write(i, refs[h][0], refs[h][2](v), refs[h][3])
             for h in ("cost_monthly_ondemand", "cost_monthly_reserved_worst", "cost_monthly_reserved_best"):
@@ -127,34 +175,27 @@ def gen_reserved_summary(workbook, header_format, val_format):
                                              refs[h][0] - 5), i+1, i+1), refs[h][3],
                     res,
                 )
-            worksheet.conditional_format("F{}".format(i+1), {
+        if last_row >= 2:
+            # The relative reference of a range rule follows its rows.
+            worksheet.conditional_format(2, 5, last_row, 5, {
                 "type": "cell",
                 "criteria": "equal to",
-                "value": "E{}".format(i+1),
+                "value": "E3",
                 "format": green_format,
             })
 
 
-def gen_reservation_usage_summary(workbook, header_format, val_format):
+def gen_reservation_usage_summary(workbook, formats):
+    header_format = formats.get(FORMAT_HEADER)
+    val_format = formats.get(FORMAT_VALUE)
     with utils.csv_folder(IN_RESERVATION_USAGE_DIR) as records:
         worksheet = workbook.add_worksheet("Reservation usage summary")
 
         worksheet.freeze_panes(2, 0)
         worksheet.set_column("A:J", 18)
-        worksheet.merge_range("A1:D1", "Reservation", header_format)
-        worksheet.merge_range("E1:F1", "Count", header_format)
-        worksheet.merge_range("G1:I1", "Cost per instance", header_format)
-        worksheet.merge_range("J1:J2", "Monthly losses", header_format)
-
-        green_format = workbook.add_format()
-        green_format.set_color(COLOR_GREEN_FG)
-        green_format.set_bg_color(COLOR_GREEN_BG)
 
-        cur_format = workbook.add_format()
-        cur_format.set_align("center")
-        cur_format.set_align("vcenter")
-        cur_format.set_border()
-        cur_format.set_num_format(NUMFORMAT_CURRENCY)
+        green_format = formats.get(FORMAT_GREEN)
+        cur_format = formats.get(FORMAT_CURRENCY)
 
         refs = {
             "instance_type": [0, "Instance type", str, val_format],
@@ -168,9 +209,15 @@ def gen_reservation_usage_summary(workbook, header_format, val_format):
             "effective_cost": [8, "Effective", float, cur_format],
             "monthly_losses": [9, "Monthly losses", float, cur_format],
         }
-        for v in refs.values():
-            worksheet.write(1, v[0], v[1], header_format)
+        write_header(worksheet, [
+            ("A1:D1", "Reservation"),
+            ("E1:F1", "Count"),
+            ("G1:I1", "Cost per instance"),
+            ("J1:J2", "Monthly losses"),
+        ] + [((1, v[0]), v[1]) for h, v in refs.items() if h != "monthly_losses"], header_format)
+        last_row = 1
         for i, line in zip(itertools.count(2), records):
+            last_row = i
             for h, v in line.items():
                 worksheet.write(i, refs[h][0], refs[h][2](v), refs[h][3])
             effective_cost = float(
@@ -180,12 +227,6 @@ def gen_reservation_usage_summary(workbook, header_format, val_format):
                 "=G{}/720+H{}".format(*[i+1]*2), refs["effective_cost"][3],
                 effective_cost,
             )
-            worksheet.conditional_format("F{}".format(i + 1), {
-                "type": "cell",
-                "criteria": "equal to",
-                "value": "E{}".format(i + 1),
-                "format": green_format,
-            })
             worksheet.write(
                 i, refs["monthly_losses"][0],
                 "=(E{}-F{})*I{}*720".format(*[i+1]
@@ -193,182 +234,193 @@ def gen_reservation_usage_summary(workbook, header_format, val_format):
                 (float(line["count"]) - float(line["count_used"])
                  ) * effective_cost * 720,
             )
-
-
-def gen_weekly_variations(workbook, header_format, val_format):
-    def to_alpha(x): return chr(ord('A') + x)
-
-    with open(IN_ABSOLUTE_COST_PER_MONTH) as f:
-        reader = csv.DictReader(f)
-        source = sorted(
-            reader,
-            key=(lambda row: sum(float(v)
-                                 for k, v in row.items() if k != 'usage')),
-            reverse=True,
-        )
-        worksheet = workbook.add_worksheet("Cost variations")
-
-        worksheet.freeze_panes(3, 1)
-        worksheet.set_column("A:A", 30)
-        worksheet.set_column("B:M", 14)
-        worksheet.merge_range("A1:A3", "Usage type", header_format)
-        worksheet.merge_range("B1:L1", "Monthly cost", header_format)
-        worksheet.merge_range("M1:M3", "Total", header_format)
-
-        green_format = workbook.add_format()
-        green_format.set_color(COLOR_GREEN_FG)
-        green_format.set_bg_color(COLOR_GREEN_BG)
-
-        red_format = workbook.add_format()
-        red_format.set_color(COLOR_RED_FG)
-        red_format.set_bg_color(COLOR_RED_BG)
-
-        cur_format = workbook.add_format()
-        cur_format.set_align("center")
-        cur_format.set_align("vcenter")
-        cur_format.set_border()
-        cur_format.set_num_format(NUMFORMAT_CURRENCY)
-
-        per_format = workbook.add_format()
-        per_format.set_align("center")
-        per_format.set_align("vcenter")
-        per_format.set_border()
-        per_format.set_num_format(NUMFORMAT_PERCENT)
-
-        date_fieldnames = reader.fieldnames[1:-1]
-        if len(date_fieldnames) > 6:
-            date_fieldnames = date_fieldnames[-5:]
-        refs = {
-            header: [i, True, float]
-            for i, header in zip(itertools.count(3, 2), date_fieldnames[1:])
-        }
-        refs[date_fieldnames[0]] = [1, False, float]
-        refs["usage"] = [0, False, str]
-        for h, v in refs.items():
-            if v[1]:
-                worksheet.merge_range(1, v[0]-1, 1, v[0], h, header_format)
-                worksheet.write(2, v[0]-1, "Variation", header_format)
-                worksheet.write(2, v[0], "Cost", header_format)
-            else:
-                worksheet.write(1, v[0], h, header_format)
-                worksheet.write(2, v[0], "Cost", header_format)
-        for i, line in zip(itertools.count(3), source):
-            for name, meta in refs.items():
-                val = line[name]
-                worksheet.write(i, meta[0], meta[2](val), cur_format)
-                if meta[1]:
-                    before = float(line[date_fieldnames[int(meta[0]/2-1)]])
-                    worksheet.write_formula(
-                        i, meta[0]-1,
-                        "=IF({}{}=0,\"\",{}{}/{}{}-1)".format(
-                            to_alpha(meta[0] - 2),
-                            i+1,
-                            to_alpha(meta[0]),
-                            i+1,
-                            to_alpha(meta[0] - 2),
-                            i+1,
-                        ), per_format,
-                        " " if before == 0.0 else meta[2](val) / before - 1
-                    )
-                    worksheet.conditional_format("{}{}".format(to_alpha(meta[0]-1), i+1), {
-                        "type": "cell",
-                        "criteria": "greater than",
-                        "value": "0",
-                        "format": red_format,
-                    })
-                    worksheet.conditional_format("{}{}".format(to_alpha(meta[0]-1), i+1), {
-                        "type": "cell",
-                        "criteria": "less than or equal to",
-                        "value": "0",
-                        "format": green_format,
-                    })
-            worksheet.write("M{}".format(
-                i+1), sum([float(line[o]) for o in reader.fieldnames[1:]]), cur_format)
-
-
-def gen_weekly_variations_chart(workbook, header_format, val_format):
-    with open(IN_ABSOLUTE_COST_PER_MONTH) as f:
-        reader = csv.DictReader(f)
-        source = sorted(
-            reader,
-            key=(lambda row: sum(float(v) for k, v in row.items() if k != 'usage')),
-            reverse=True,
-        )[:5]
-
-        header = ['usage'] + sorted([s for s in source[0] if s != 'usage'])
-        data = [
-            [float(s[h]) if h != 'usage' else s[h] for h in header]
-            for s in source
-        ]
-        chart = workbook.add_chart({
-            "type": "line"
-        })
-        chartsheet = workbook.add_worksheet("Cost variations chart")
-        chartsheet.add_table(1, 1, len(data)+1, len(header)-1, {'data': data, 'columns': [{'header': h} for h in header]})
-        for i in range(2, len(data)+1):
-            chart.add_series({
-                "values": ["Cost variations chart", i, 2, i, len(header)-1],
-                "categories": ["Cost variations chart", 1, 2, 1, len(header)-1],
-                "name": ["Cost variations chart", i, 1],
+        if last_row >= 2:
+            worksheet.conditional_format(2, 5, last_row, 5, {
+                "type": "cell",
+                "criteria": "equal to",
+                "value": "E3",
+                "format": green_format,
             })
-        chartsheet.insert_chart('A1', chart, {'x_scale': 3, 'y_scale': 2})
 
 
-def gen_instance_count_history(workbook, header_format, val_format):
-    with open(IN_INSTANCE_HISTORY) as f:
+def prepare_weekly_variations():
+    """prepare_weekly_variations reads the monthly costs of each usage type,
+    along with their total, sorted by decreasing total."""
+    with open(IN_ABSOLUTE_COST_PER_MONTH) as f:
         reader = csv.DictReader(f)
-        worksheet = workbook.add_worksheet("Instance count history")
+        months = reader.fieldnames[1:]
+        source = []
+        for line in reader:
+            costs = [float(line[m]) for m in months]
+            source.append((line['usage'], costs, sum(costs)))
+    source.sort(key=lambda row: row[2], reverse=True)
+    return months, source
 
-        worksheet.freeze_panes(2, 1)
-        worksheet.set_column(0, len(reader.fieldnames), 18)
-        worksheet.merge_range("A1:A2", "Date", header_format)
-        worksheet.merge_range(0, 1, 0, len(reader.fieldnames), "Instance Count", header_format)
 
-        def transform(x):
-            try:
-                if x == "":
-                    return 0
-                else:
-                    return int(x)
-            except ValueError:
-                return x
+def gen_weekly_variations(workbook, formats, prepared):
+    header_format = formats.get(FORMAT_HEADER)
+    def to_alpha(x): return chr(ord('A') + x)
 
-        refs = {
-            header: [
-                i,
-                transform,
-            ] for i, header in zip(itertools.count(), reader.fieldnames + ["Total"])
+    months, source = prepared
+    month_index = {m: i for i, m in enumerate(months)}
+    worksheet = workbook.add_worksheet("Cost variations")
+
+    worksheet.freeze_panes(3, 1)
+    worksheet.set_column("A:A", 30)
+    worksheet.set_column("B:M", 14)
+
+    green_format = formats.get(FORMAT_GREEN)
+    red_format = formats.get(FORMAT_RED)
+    cur_format = formats.get(FORMAT_CURRENCY)
+    per_format = formats.get(FORMAT_PERCENT)
+
+    date_fieldnames = months[:-1]
+    if len(date_fieldnames) > 6:
+        date_fieldnames = date_fieldnames[-5:]
+    refs = {
+        header: [i, True]
+        for i, header in zip(itertools.count(3, 2), date_fieldnames[1:])
+    }
+    refs[date_fieldnames[0]] = [1, False]
+    header = [
+        ("A1:A3", "Usage type"),
+        ("B1:L1", "Monthly cost"),
+        ("M1:M3", "Total"),
+    ]
+    for h, v in refs.items():
+        if v[1]:
+            header.append(((1, v[0]-1, 1, v[0]), h))
+            header.append(((2, v[0]-1), "Variation"))
+            header.append(((2, v[0]), "Cost"))
+        else:
+            header.append(((1, v[0]), h))
+            header.append(((2, v[0]), "Cost"))
+    write_header(worksheet, header, header_format)
+    for i, (usage, costs, total) in zip(itertools.count(3), source):
+        worksheet.write(i, 0, usage, cur_format)
+        for name, meta in refs.items():
+            cost = costs[month_index[name]]
+            worksheet.write(i, meta[0], cost, cur_format)
+            if meta[1]:
+                before = costs[month_index[date_fieldnames[int(meta[0]/2-1)]]]
+                worksheet.write_formula(
+                    i, meta[0]-1,
+                    "=IF({}{}=0,\"\",{}{}/{}{}-1)".format(
+                        to_alpha(meta[0] - 2),
+                        i+1,
+                        to_alpha(meta[0]),
+                        i+1,
+                        to_alpha(meta[0] - 2),
+                        i+1,
+                    ), per_format,
+                    " " if before == 0.0 else cost / before - 1
+                )
+        worksheet.write("M{}".format(i+1), total, cur_format)
+    if source:
+        increase = {
+            "type": "cell",
+            "criteria": "greater than",
+            "value": "0",
+            "format": red_format,
         }
-        for h, v in refs.items():
-            worksheet.write(1, v[0], h, header_format)
-        for i, line in zip(itertools.count(2), reader):
-            for h, v in line.items():
-                worksheet.write(i, refs[h][0], refs[h][1](v), val_format)
-            total = sum([transform(v) for h, v in line.items() if h != 'date'])
-            worksheet.write(i, refs['Total'][0], refs['Total'][1](total), val_format)
+        decrease = {
+            "type": "cell",
+            "criteria": "less than or equal to",
+            "value": "0",
+            "format": green_format,
+        }
+        for meta in refs.values():
+            if meta[1]:
+                worksheet.conditional_format(3, meta[0]-1, len(source)+2, meta[0]-1, increase)
+                worksheet.conditional_format(3, meta[0]-1, len(source)+2, meta[0]-1, decrease)
+
+
+def gen_weekly_variations_chart(workbook, formats, prepared):
+    header_format = formats.get(FORMAT_HEADER)
+    val_format = formats.get(FORMAT_VALUE)
+    months, source = prepared
+    # The usage types are already sorted by decreasing total.
+    order = sorted(range(len(months)), key=months.__getitem__)
+    header = ['usage'] + [months[i] for i in order]
+    data = [
+        [usage] + [costs[i] for i in order]
+        for usage, costs, _ in source[:5]
+    ]
+    chart = workbook.add_chart({
+        "type": "line"
+    })
+    chartsheet = workbook.add_worksheet("Cost variations chart")
+    chartsheet.write_row(1, 1, header, header_format)
+    for i, row in zip(itertools.count(2), data):
+        chartsheet.write_row(i, 1, row, val_format)
+    for i in range(2, len(data)+2):
+        chart.add_series({
+            "values": ["Cost variations chart", i, 2, i, len(header)],
+            "categories": ["Cost variations chart", 1, 2, 1, len(header)],
+            "name": ["Cost variations chart", i, 1],
+        })
+    chartsheet.insert_chart('A1', chart, {'x_scale': 3, 'y_scale': 2})
 
 
-def gen_instance_count_history_chart(workbook, header_format, val_format):
+def prepare_instance_count_history():
+    """prepare_instance_count_history reads the instance counts of each date,
+    followed by their total."""
+    def transform(x):
+        try:
+            if x == "":
+                return 0
+            else:
+                return int(x)
+        except ValueError:
+            return x
+
     with open(IN_INSTANCE_HISTORY) as f:
         reader = csv.DictReader(f)
-
-        chart = workbook.add_chart({
-            "type": "line"
+        rows = []
+        for line in reader:
+            row = [transform(line[h]) for h in reader.fieldnames]
+            rows.append(row + [sum(row[1:])])
+    return reader.fieldnames, rows
+
+
+def gen_instance_count_history(workbook, formats, prepared):
+    header_format = formats.get(FORMAT_HEADER)
+    val_format = formats.get(FORMAT_VALUE)
+    fieldnames, rows = prepared
+    worksheet = workbook.add_worksheet("Instance count history")
+
+    worksheet.freeze_panes(2, 1)
+    worksheet.set_column(0, len(fieldnames), 18)
+
+    write_header(worksheet, [
+        ("A1:A2", "Date"),
+        ((0, 1, 0, len(fieldnames)), "Instance Count"),
+    ] + [((1, i), h) for i, h in enumerate(fieldnames + ["Total"]) if i != 0], header_format)
+    for i, row in zip(itertools.count(2), rows):
+        worksheet.write_row(i, 0, row, val_format)
+
+
+def gen_instance_count_history_chart(workbook, formats, prepared):
+    fieldnames, rows = prepared
+    row_len = len(rows)
+    chart = workbook.add_chart({
+        "type": "line"
+    })
+    for i, fieldname in zip(itertools.count(1), fieldnames[1:] + ["Total"]):
+        chart.add_series({
+            "values": ["Instance count history", 2, i, row_len+1, i],
+            "categories": ["Instance count history", 2, 0, row_len+1, 0],
+            "name": fieldname,
         })
-        row_len = len(list(reader))
-        for i, fieldname in zip(itertools.count(1), reader.fieldnames[1:] + ["Total"]):
-            chart.add_series({
-                "values": ["Instance count history", 2, i, row_len-1, i],
-                "categories": ["Instance count history", 2, 0, row_len-1, 0],
-                "name": fieldname,
-            })
-        chartsheet = workbook.add_chartsheet("Instance count history chart")
-        chartsheet.set_chart(chart)
+    chartsheet = workbook.add_chartsheet("Instance count history chart")
+    chartsheet.set_chart(chart)
 
 
-def gen_instance_size_recommendations(workbook, header_format, val_format):
+def gen_instance_size_recommendations(workbook, formats):
+    header_format = formats.get(FORMAT_HEADER)
+    val_format = formats.get(FORMAT_VALUE)
     def transform(h, v):
-        if h == "cpu_usage":
+        if h in ("cpu_usage", "cpu_p50", "cpu_p95", "cpu_max"):
             try:
                 return "%.3f%%" % (float(v)*100)
             except ValueError:
@@ -379,13 +431,9 @@ def gen_instance_size_recommendations(workbook, header_format, val_format):
         worksheet = workbook.add_worksheet("Instance size recommendations")
 
         worksheet.set_column("A:E", 25)
-        worksheet.set_column("F:F", 20)
-        worksheet.set_column("G:H", 18)
-        worksheet.set_column("I:I", 35)
-        worksheet.merge_range("A1:F1", "Instance", header_format)
-        worksheet.merge_range("G1:G2", "Recommended", header_format)
-        worksheet.merge_range("H1:H2", "Potential saving", header_format)
-        worksheet.merge_range("I1:I2", "Reason", header_format)
+        worksheet.set_column("F:I", 20)
+        worksheet.set_column("J:K", 18)
+        worksheet.set_column("L:L", 35)
 
         worksheet.freeze_panes(2, 0)
 
@@ -395,18 +443,29 @@ def gen_instance_size_recommendations(workbook, header_format, val_format):
             "name": [2, "Name"],
             "size": [3, "Type"],
             "lifecycle": [4, "Lifecycle"],
-            "cpu_usage": [5, "CPU Utilization (Avg.)"],
-            "recommendation": [6, "Recommendation"],
-            "saving": [7, "Saving"],
-            "reason": [8, "Reason"]
+            "cpu_usage": [5, "Selected"],
+            "cpu_p50": [6, "p50"],
+            "cpu_p95": [7, "p95"],
+            "cpu_max": [8, "Max"],
+            "recommendation": [9, "Recommendation"],
+            "saving": [10, "Saving"],
+            "reason": [11, "Reason"]
         }
-        for i in refs.values():
-            worksheet.write(1, i[0], i[1], header_format)
-            for i, line in zip(itertools.count(2), source):
-                for h, v in line.items():
-                    worksheet.write(i, refs[h][0], transform(h, v), val_format)
+        write_header(worksheet, [
+            ("A1:E1", "Instance"),
+            ("F1:I1", "CPU Utilization"),
+            ("J1:J2", "Recommended"),
+            ("K1:K2", "Potential saving"),
+            ("L1:L2", "Reason"),
+        ] + [((1, v[0]), v[1]) for v in refs.values() if v[0] < 9], header_format)
+        for i, line in zip(itertools.count(2), source):
+            for h, v in line.items():
+                worksheet.write(i, refs[h][0], transform(h, v), val_format)
 
-def instance_summary(workbook, header_format, val_format):
+def prepare_instance_summary():
+    """prepare_instance_summary reads the cost of each instance last month,
+    adds the cost of its bandwidth and EBS volumes, and sorts the instances
+    by decreasing total cost."""
     bandwidth_usage = {}
     ebs_usage = defaultdict(int)
     def transform(x):
@@ -425,49 +484,54 @@ def instance_summary(workbook, header_format, val_format):
             ebs_usage[line[4]] += transform(line[3])
     with open(IN_INSTANCE_USAGE_LAST_MONTH) as f:
         reader = csv.DictReader(f)
-        worksheet = workbook.add_worksheet("EC2 instances last month")
-
-        last_month = datetime.now() + dateutil.relativedelta.relativedelta(months=-1)
-        worksheet.merge_range("A1:I1", "Instances for {}-{:02d}".format(last_month.year, last_month.month), header_format)
-        worksheet.merge_range("J1:J2", "Total", header_format)
-
-        cur_format = workbook.add_format()
-        cur_format.set_align("center")
-        cur_format.set_align("vcenter")
-        cur_format.set_border()
-        cur_format.set_num_format(NUMFORMAT_CURRENCY)
-
-        worksheet.freeze_panes(2, 0)
-        worksheet.set_column(2, len(reader.fieldnames)+2, 18)
-        worksheet.set_column("A:C", 33)
-
-        refs = {
-            "Account": [0, "Account", str, val_format],
-            "ResourceId": [1, "Resource Id", str, val_format],
-            "Name": [2, "Name", str, val_format],
-            "AvailabilityZone": [3, "Availability zone", str, val_format],
-            "Term": [4, "Term", str, val_format],
-            "Type": [5, "Type", str, val_format],
-            "Cost": [6, "Instance cost", transform, cur_format],
-            "Bandwidth": [7, "Bandwidth cost", transform, cur_format],
-            "EBS": [8, "EBS cost", transform, cur_format],
-        }
         ec2_cost_data = []
-        for i, line in zip(itertools.count(2), reader):
-            line['Bandwidth'] = refs['Bandwidth'][2](bandwidth_usage.get(line['ResourceId'], ''))
-            line['EBS'] = refs['EBS'][2](ebs_usage.get(line['ResourceId'], ''))
-            line['Total'] = refs['Cost'][2](line['Cost']) + line['Bandwidth'] + line['EBS']
+        for line in reader:
+            line['Cost'] = transform(line['Cost'])
+            line['Bandwidth'] = transform(bandwidth_usage.get(line['ResourceId'], ''))
+            line['EBS'] = transform(ebs_usage.get(line['ResourceId'], ''))
+            line['Total'] = line['Cost'] + line['Bandwidth'] + line['EBS']
             ec2_cost_data.append(line)
-        ec2_cost_data.sort(key=lambda e: e['Total'], reverse=True)
-        for v in refs.values():
-            worksheet.write(1, v[0], v[1], header_format)
-        for i, line in zip(itertools.count(2), ec2_cost_data):
-            for h, v in line.items():
-                if h != 'Total':
-                    worksheet.write(i, refs[h][0], refs[h][2](v), refs[h][3])
-            worksheet.write(i, len(refs), line['Total'], cur_format)
-
-def ebs_summary(workbook, header_format, val_format):
+    ec2_cost_data.sort(key=lambda e: e['Total'], reverse=True)
+    return reader.fieldnames, ec2_cost_data
+
+def instance_summary(workbook, formats, prepared):
+    header_format = formats.get(FORMAT_HEADER)
+    val_format = formats.get(FORMAT_VALUE)
+    fieldnames, ec2_cost_data = prepared
+    worksheet = workbook.add_worksheet("EC2 instances last month")
+
+    last_month = datetime.now() + dateutil.relativedelta.relativedelta(months=-1)
+
+    cur_format = formats.get(FORMAT_CURRENCY)
+
+    worksheet.freeze_panes(2, 0)
+    worksheet.set_column(2, len(fieldnames)+2, 18)
+    worksheet.set_column("A:C", 33)
+
+    refs = {
+        "Account": [0, "Account", val_format],
+        "ResourceId": [1, "Resource Id", val_format],
+        "Name": [2, "Name", val_format],
+        "AvailabilityZone": [3, "Availability zone", val_format],
+        "Term": [4, "Term", val_format],
+        "Type": [5, "Type", val_format],
+        "Cost": [6, "Instance cost", cur_format],
+        "Bandwidth": [7, "Bandwidth cost", cur_format],
+        "EBS": [8, "EBS cost", cur_format],
+    }
+    write_header(worksheet, [
+        ("A1:I1", "Instances for {}-{:02d}".format(last_month.year, last_month.month)),
+        ("J1:J2", "Total"),
+    ] + [((1, v[0]), v[1]) for v in refs.values()], header_format)
+    for i, line in zip(itertools.count(2), ec2_cost_data):
+        for h, v in line.items():
+            if h != 'Total':
+                worksheet.write(i, refs[h][0], v, refs[h][2])
+        worksheet.write(i, len(refs), line['Total'], cur_format)
+
+def ebs_summary(workbook, formats):
+    header_format = formats.get(FORMAT_HEADER)
+    val_format = formats.get(FORMAT_VALUE)
     def transform(x):
         try:
             if x == "": return 0.0
@@ -479,18 +543,8 @@ def ebs_summary(workbook, header_format, val_format):
         worksheet = workbook.add_worksheet("EBS last month")
 
         last_month = datetime.now() + dateutil.relativedelta.relativedelta(months=-1)
-        worksheet.merge_range("A1:F1", "EBS for {}-{:02d}".format(last_month.year, last_month.month), header_format)
-        worksheet.merge_range("A2:A3", "Account", header_format)
-        worksheet.merge_range("B2:B3", "Resource ID", header_format)
-        worksheet.merge_range("C2:C3", "Region", header_format)
-        worksheet.merge_range("D2:D3", "Cost", header_format)
-        worksheet.merge_range("E2:F2", "Instance Linked", header_format)
-
-        cur_format = workbook.add_format()
-        cur_format.set_align("center")
-        cur_format.set_align("vcenter")
-        cur_format.set_border()
-        cur_format.set_num_format(NUMFORMAT_CURRENCY)
+
+        cur_format = formats.get(FORMAT_CURRENCY)
 
         worksheet.freeze_panes(3, 0)
         worksheet.set_column(0, len(reader.fieldnames)-1, 25)
@@ -503,13 +557,21 @@ def ebs_summary(workbook, header_format, val_format):
             "InstanceId": [4, "ID", str, val_format],
             "InstanceName": [5, "Name", str, val_format],
         }
-        for v in refs.values():
-            worksheet.write(2, v[0], v[1], header_format)
+        write_header(worksheet, [
+            ("A1:F1", "EBS for {}-{:02d}".format(last_month.year, last_month.month)),
+            ("A2:A3", "Account"),
+            ("B2:B3", "Resource ID"),
+            ("C2:C3", "Region"),
+            ("D2:D3", "Cost"),
+            ("E2:F2", "Instance Linked"),
+        ] + [((2, v[0]), v[1]) for v in refs.values() if v[0] >= 4], header_format)
         for i, line in zip(itertools.count(3), reader):
             for h, v in line.items():
                 worksheet.write(i, refs[h][0], refs[h][2](v), refs[h][3])
 
-def snapshots_summary(workbook, header_format, val_format):
+def snapshots_summary(workbook, formats):
+    header_format = formats.get(FORMAT_HEADER)
+    val_format = formats.get(FORMAT_VALUE)
     def transform(x):
         try:
             if x == "": return 0.0
@@ -521,13 +583,8 @@ def snapshots_summary(workbook, header_format, val_format):
         worksheet = workbook.add_worksheet("Snapshots last month")
 
         last_month = datetime.now() + dateutil.relativedelta.relativedelta(months=-1)
-        worksheet.merge_range("A1:C1", "Snapshots for {}-{:02d}".format(last_month.year, last_month.month), header_format)
 
-        cur_format = workbook.add_format()
-        cur_format.set_align("center")
-        cur_format.set_align("vcenter")
-        cur_format.set_border()
-        cur_format.set_num_format(NUMFORMAT_CURRENCY)
+        cur_format = formats.get(FORMAT_CURRENCY)
 
         worksheet.freeze_panes(2, 0)
         worksheet.set_column(0, 0, 25)
@@ -539,13 +596,16 @@ def snapshots_summary(workbook, header_format, val_format):
             "ResourceId": [1, "Resource Id", str, val_format],
             "Cost": [2, "Cost", transform, cur_format],
         }
-        for v in refs.values():
-            worksheet.write(1, v[0], v[1], header_format)
+        write_header(worksheet, [
+            ("A1:C1", "Snapshots for {}-{:02d}".format(last_month.year, last_month.month)),
+        ] + [((1, v[0]), v[1]) for v in refs.values()], header_format)
         for i, line in zip(itertools.count(2), reader):
             for h, v in line.items():
                 worksheet.write(i, refs[h][0], refs[h][2](v), refs[h][3])
 
-def gen_s3_cost(workbook, header_format, val_format):
+def gen_s3_cost(workbook, formats):
+    header_format = formats.get(FORMAT_HEADER)
+    val_format = formats.get(FORMAT_VALUE)
     def transform(x):
         try:
             if x == "": return 0.0
@@ -556,13 +616,8 @@ def gen_s3_cost(workbook, header_format, val_format):
         reader = csv.DictReader(f)
         worksheet = workbook.add_worksheet("S3 cost")
 
-        worksheet.merge_range("A1:F1", "S3 cost for current month", header_format)
 
-        cur_format = workbook.add_format()
-        cur_format.set_align("center")
-        cur_format.set_align("vcenter")
-        cur_format.set_border()
-        cur_format.set_num_format(NUMFORMAT_CURRENCY)
+        cur_format = formats.get(FORMAT_CURRENCY)
 
         worksheet.freeze_panes(2, 0)
         worksheet.set_column(0, 0, 45)
@@ -582,44 +637,58 @@ def gen_s3_cost(workbook, header_format, val_format):
             "CurrentTotal": [5, "Current cost", transform, cur_format],
             "LastMonthTotal": [6, "Last month cost", transform, cur_format],
         }
-        for v in refs.values():
-            worksheet.write(1, v[0], v[1], header_format)
+        write_header(worksheet, [
+            ("A1:F1", "S3 cost for current month"),
+        ] + [((1, v[0]), v[1]) for v in refs.values()], header_format)
         for i, line in zip(itertools.count(2), reader):
             for h, v in line.items():
                 worksheet.write(i, refs[h][0], refs[h][2](v), refs[h][3])
 
-def gen_introduction(workbook, header_format, val_format):
+def gen_introduction(workbook, formats):
     worksheet = workbook.add_worksheet("Introduction")
 
     worksheet.insert_image("A1", "src/ressources/introduction.png")
 
 
+# SHEET_BUILDERS lists the sheets of the report in order. Builders which
+# must read their whole input before writing, to sort or total it, come with
+# a prepare function run in a worker process; its result is passed to the
+# builder. Each prepare function runs once per report, and builders sharing
+# one get the same result. The others stream their input straight into the
+# worksheet.
+SHEET_BUILDERS = (
+    (gen_introduction, None),
+    (gen_weekly_variations, prepare_weekly_variations),
+    (gen_weekly_variations_chart, prepare_weekly_variations),
+    (gen_reserved_summary, None),
+    (gen_reservation_usage_summary, None),
+    (gen_instance_size_recommendations, None),
+    (gen_instance_count_history_chart, prepare_instance_count_history),
+    (gen_instance_count_history, prepare_instance_count_history),
+    (instance_summary, prepare_instance_summary),
+    (ebs_summary, None),
+    (snapshots_summary, None),
+    (gen_s3_cost, None),
+)
+
+
 def main(name):
-    workbook = xlsxwriter.Workbook('./out/{}.xlsx'.format(name))
-
-    header_format = workbook.add_format()
-    header_format.set_bold()
-    header_format.set_align("center")
-    header_format.set_align("vcenter")
-    header_format.set_border()
-
-    val_format = workbook.add_format()
-    val_format.set_align("center")
-    val_format.set_align("vcenter")
-    val_format.set_border()
-
-    gen_introduction(workbook, header_format, val_format)
-    gen_weekly_variations(workbook, header_format, val_format)
-    gen_weekly_variations_chart(workbook, header_format, val_format)
-    gen_reserved_summary(workbook, header_format, val_format)
-    gen_reservation_usage_summary(workbook, header_format, val_format)
-    gen_instance_size_recommendations(workbook, header_format, val_format)
-    gen_instance_count_history_chart(workbook, header_format, val_format)
-    gen_instance_count_history(workbook, header_format, val_format)
-    instance_summary(workbook, header_format, val_format)
-    ebs_summary(workbook, header_format, val_format)
-    snapshots_summary(workbook, header_format, val_format)
-    gen_s3_cost(workbook, header_format, val_format)
+    # Each sheet is written row by row so that constant_memory mode can flush
+    # every row as soon as the next one starts, whatever the report size.
+    workbook = xlsxwriter.Workbook('./out/{}.xlsx'.format(name), {'constant_memory': True})
+
+    formats = FormatRegistry(workbook)
+
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        prepared = {}
+        for _, prepare in SHEET_BUILDERS:
+            if prepare is not None and prepare not in prepared:
+                prepared[prepare] = pool.submit(prepare)
+        for build, prepare in SHEET_BUILDERS:
+            if prepare is None:
+                build(workbook, formats)
+            else:
+                build(workbook, formats, prepared[prepare].result())
 
     workbook.close()
 
@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+
+DIR_PRICING = 'in/persistent/pricing'
+MANIFEST_VERSION = 2
+
+REGION_LOCATIONS = {
+    'us-east-2': 'US East (Ohio)',
+    'us-east-1': 'US East (N. Virginia)',
+    'us-west-1': 'US West (N. California)',
+    'us-west-2': 'US West (Oregon)',
+    'ap-northeast-1': 'Asia Pacific (Tokyo)',
+    'ap-northeast-2': 'Asia Pacific (Seoul)',
+    'ap-northeast-3': 'Asia Pacific (Osaka-Local)',
+    'ap-east-1': 'Asia Pacific (Hong Kong)',
+    'ap-south-1': 'Asia Pacific (Mumbai)',
+    'ap-southeast-1': 'Asia Pacific (Singapore)',
+    'ap-southeast-2': 'Asia Pacific (Sydney)',
+    'ca-central-1': 'Canada (Central)',
+    'cn-north-1': 'China (Beijing)',
+    'cn-northwest-1': 'China (Ningxia)',
+    'eu-central-1': 'EU (Frankfurt)',
+    'eu-west-1': 'EU (Ireland)',
+    'eu-west-2': 'EU (London)',
+    'eu-west-3': 'EU (Paris)',
+    'eu-north-1': 'EU (Stockholm)',
+    'me-south-1': 'Middle East (Bahrain)',
+    'sa-east-1': 'South America (Sao Paulo)',
+    'us-gov-east-1': 'AWS GovCloud (US-East)',
+    'us-gov-west-1': 'AWS GovCloud (US-West)',
+}
+
+LOCATION_REGIONS = {location: region for region, location in REGION_LOCATIONS.items()}
+
+def location_region(location):
+    """location_region returns the region of a price list location, or None
+    when it is unknown."""
+    return LOCATION_REGIONS.get(location)
+
+def price_key(instance_type, tenancy, operating_system):
+    """price_key identifies a price within the table of a region."""
+    return (instance_type, tenancy, operating_system)
+
+PRICE_ATTRIBUTES = ('instanceType', 'location', 'tenancy', 'operatingSystem', 'regionCode')
+
+def price_attributes(attributes):
+    """price_attributes returns the attributes of a product of the price list
+    which its price is looked up by, as a tuple in PRICE_ATTRIBUTES order."""
+    return tuple(attributes.get(attribute) for attribute in PRICE_ATTRIBUTES)
+
+def price_row(attributes, cost):
+    """price_row returns the [instance type, location, tenancy, operating
+    system, cost, region] row of a product from its price_attributes. The
+    region is the product's region code, or the region of its location for
+    offers which predate region codes, or None when neither is known."""
+    instance_type, location, tenancy, operating_system, region = attributes
+    return [instance_type, location, tenancy, operating_system, cost, region or location_region(location)]
+
+def build_index(rows):
+    """build_index maps the price key of each row of a region's table to its
+    hourly cost. When several products share a key, the first one wins, as
+    it did with the linear scan of the price list."""
+    index = {}
+    for row in rows:
+        index.setdefault(price_key(row[0], row[2], row[3]), row[4])
+    return index
+
+def _write_json(data, filepath):
+    tmppath = filepath + '.tmp'
+    with open(tmppath, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmppath, filepath)
+
+def _manifest_path(cachedir):
+    return os.path.join(cachedir, 'manifest.json')
+
+def region_path(cachedir, region):
+    return os.path.join(cachedir, '{}.json'.format(region))
+
+def read_manifest(cachedir=DIR_PRICING):
+    """read_manifest returns the manifest of the pricing cache, which records
+    for each region the offer its prices were read from and the offer's
+    publication date."""
+    try:
+        with open(_manifest_path(cachedir)) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        # A corrupt manifest is rebuilt as if the cache were empty.
+        manifest = None
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return {'version': MANIFEST_VERSION, 'regions': {}}
+    return manifest
+
+def write_manifest(manifest, cachedir=DIR_PRICING):
+    _write_json(manifest, _manifest_path(cachedir))
+
+def write_region(rows, region, cachedir=DIR_PRICING):
+    _write_json(rows, region_path(cachedir, region))
+
+def read_region(region, cachedir=DIR_PRICING):
+    try:
+        with open(region_path(cachedir, region)) as f:
+            return build_index(json.load(f))
+    except FileNotFoundError:
+        return {}
+
+class PriceIndex:
+    """PriceIndex looks up on-demand prices in the region tables of the
+    pricing cache. A region's table is read the first time one of its prices
+    is looked up."""
+    def __init__(self, cachedir=DIR_PRICING):
+        self.cachedir = cachedir
+        self.regions = {}
+        self.lock = threading.Lock()
+
+    def region(self, region):
+        with self.lock:
+            if region not in self.regions:
+                self.regions[region] = read_region(region, self.cachedir)
+            return self.regions[region]
+
+    def ondemand_cost(self, region, instance_type, tenancy, operating_system):
+        """ondemand_cost returns the hourly on-demand cost of an instance
+        type in a region, or None when the region's table does not know
+        it."""
+        return self.region(region).get(price_key(instance_type, tenancy, operating_system))
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+
+import usagecost
+from get_bill_diff import ENGINES
+from get_ec2_instance_history import InstanceHistory
+from get_last_month_ec2_cost import LastMonthEc2Usage
+from get_last_month_ebs_cost import LastMonthEbsUsage
+from get_s3_cost import S3Usage
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', help='number of worker processes', type=int, default=os.cpu_count())
+    parser.add_argument('--engine', help='engine of the monthly cost breakdown', choices=ENGINES.keys(), default='python')
+    args = parser.parse_args()
+    usagecost.run([
+        ENGINES[args.engine](),
+        InstanceHistory(),
+        LastMonthEc2Usage(),
+        LastMonthEbsUsage(),
+        S3Usage(),
+    ], jobs=args.jobs)
@@ -0,0 +1,155 @@
+import random
+import threading
+import time
+
+import botocore.config
+import botocore.exceptions
+
+THROTTLING_ERRORS = frozenset([
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+])
+
+DEFAULT_RATE = 20.0
+DEFAULT_BURST = 50
+DEFAULT_CONCURRENCY = 4
+MAX_CONCURRENCY = 16
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+CLIENT_CONFIG = botocore.config.Config(retries={'max_attempts': 0})
+
+def is_throttling(error):
+    return error.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+
+class TokenBucket:
+    """TokenBucket lets through rate calls per second on average, and up to
+    burst calls at once after a quiet period."""
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class AdaptiveConcurrency:
+    """AdaptiveConcurrency bounds the number of calls in flight. The bound
+    grows by one after as many successful calls as the bound while there is
+    headroom, and is halved whenever a call is throttled."""
+    def __init__(self, initial=DEFAULT_CONCURRENCY, minimum=1, maximum=MAX_CONCURRENCY):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def succeeded(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit:
+                self.successes = 0
+                if self.limit < self.maximum:
+                    self.limit += 1
+                    self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            self.successes = 0
+            self.limit = max(self.minimum, self.limit // 2)
+
+class Throttle:
+    """Throttle runs the API calls made to a service in a region through a
+    token bucket and an adaptive concurrency bound, and retries throttled
+    calls with jittered exponential backoff."""
+    def __init__(self, name, bucket=None, concurrency=None, attempts=MAX_ATTEMPTS):
+        self.name = name
+        self.bucket = bucket or TokenBucket()
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        self.attempts = attempts
+
+    def call(self, fct, *args, **kwargs):
+        for attempt in range(self.attempts):
+            with self.concurrency:
+                self.bucket.acquire()
+                try:
+                    result = fct(*args, **kwargs)
+                except botocore.exceptions.ClientError as e:
+                    if not is_throttling(e) or attempt + 1 == self.attempts:
+                        raise
+                    self.concurrency.throttled()
+                else:
+                    self.concurrency.succeeded()
+                    return result
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            print('[{}] Throttled, retrying in {:.1f}s...'.format(self.name, delay))
+            time.sleep(delay)
+
+throttles = {}
+throttles_lock = threading.Lock()
+
+def region_throttle(service, region):
+    with throttles_lock:
+        if (service, region) not in throttles:
+            throttles[(service, region)] = Throttle('{} - {}'.format(service, region))
+        return throttles[(service, region)]
+
+class Client:
+    """Client wraps a boto3 client so that its API calls go through a
+    Throttle. paginate() follows the NextToken of an operation's pages."""
+    def __init__(self, client, throttle):
+        self.client = client
+        self.throttle = throttle
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        def call(*args, **kwargs):
+            return self.throttle.call(method, *args, **kwargs)
+        return call
+
+    def paginate(self, operation, **kwargs):
+        method = getattr(self, operation)
+        while True:
+            page = method(**kwargs)
+            yield page
+            token = page.get('NextToken')
+            if not token:
+                return
+            kwargs = dict(kwargs, NextToken=token)
+
+def client(session, service, region=None):
+    """client returns a throttled client of a boto3 session, sharing the
+    Throttle of its service and region with all other such clients of the
+    process. botocore's own retries are disabled, so that throttled calls are
+    only retried by the Throttle."""
+    region = region or session.region_name
+    return Client(
+        session.client(service, region_name=region, config=CLIENT_CONFIG),
+        region_throttle(service, region),
+    )
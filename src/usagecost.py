@@ -0,0 +1,338 @@
+import array
+import calendar
+import concurrent.futures
+import csv
+import functools
+import json
+import mmap
+import os
+import shutil
+import time
+
+import numpy
+
+import utils
+
+DIR_USAGECOST = 'in/usagecost'
+DIR_USAGECOST_CACHE = 'in/persistent/usagecost-cache'
+
+# CACHE_VERSION must be bumped whenever the layout of the columnar cache
+# changes, so that stale caches are rebuilt instead of misread.
+CACHE_VERSION = 1
+CACHE_CHUNK_ROWS = 1 << 16
+SCAN_CHUNK_ROWS = 1 << 20
+BATCH_ROWS = 1 << 16
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Hourly reports only have about 720 distinct usage start dates per month,
+# repeated for every line item, so timestamps and month indexes are memoized.
+TIMESTAMP_CACHE_SIZE = 1 << 16
+
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_timestamp(s):
+    """parse_timestamp returns the seconds since the epoch of a
+    YYYY-MM-DDTHH:MM:SSZ timestamp, decoded from fixed offsets."""
+    if len(s) == 20 and s[4] == '-' and s[7] == '-' and s[10] == 'T' and s[13] == ':' and s[16] == ':' and s[19] == 'Z':
+        return calendar.timegm((int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19])))
+    return calendar.timegm(time.strptime(s, TIMESTAMP_FORMAT))
+
+def format_timestamp(timestamp):
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(timestamp))
+
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def month_index(timestamp):
+    """month_index returns the number of months since year 0 of a timestamp,
+    as year * 12 + month - 1."""
+    t = time.gmtime(timestamp)
+    return t.tm_year * 12 + t.tm_mon - 1
+
+def parse_float(s):
+    return float(s) if s else 0.0
+
+# Columns which are not kept as strings, with their parser and the typecode of
+# their array in the columnar cache. Every record yielded by scan holds these
+# already parsed: timestamps as seconds since the epoch, costs as floats.
+TYPED_COLUMNS = {
+    'lineItem/UsageStartDate': (parse_timestamp, 'q'),
+    'lineItem/UsageAmount': (parse_float, 'd'),
+    'lineItem/UnblendedCost': (parse_float, 'd'),
+}
+TYPED_PARSERS = {
+    column: parse
+    for column, (parse, _) in TYPED_COLUMNS.items()
+}
+STRING_TYPECODE = 'I'
+
+def _csv_records(filepath, columns):
+    with open(filepath) as f:
+        yield from utils.projected_rows(f, columns, TYPED_PARSERS)
+
+def _cache_path(filename, cachepath):
+    return os.path.join(cachepath, filename)
+
+def _cache_source(filepath):
+    stat = os.stat(filepath)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+    }
+
+def _cache_meta(filepath, cachedir):
+    try:
+        with open(os.path.join(cachedir, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != CACHE_VERSION or meta.get('source') != _cache_source(filepath):
+        return None
+    return meta
+
+def _map_column(cachedir, index, typecode):
+    with open(os.path.join(cachedir, '{}.bin'.format(index)), 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return array.array(typecode)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode)
+
+def read_column(cachedir, meta, column):
+    """read_column returns the values of a column of a cached file as a
+    memory-mapped sequence, along with its dictionary if the column is
+    dictionary-encoded, or None."""
+    index = meta['columns'].index(column)
+    typecode = meta['typecodes'][index]
+    values = _map_column(cachedir, index, typecode)
+    if typecode != STRING_TYPECODE:
+        return values, None
+    with open(os.path.join(cachedir, '{}.json'.format(index))) as f:
+        return values, json.load(f)
+
+def _cached_records(cachedir, meta, columns, start=0, stop=None):
+    names = [column for column in columns if column in meta['columns']]
+    index = {column: i for i, column in enumerate(names)}
+    iterators = []
+    for column in names:
+        values, dictionary = read_column(cachedir, meta, column)
+        values = values[start:stop]
+        iterators.append(values if dictionary is None else map(dictionary.__getitem__, values))
+    for values in zip(*iterators):
+        yield utils.Record(values, index)
+
+def _cached_batch(cachedir, meta, columns, start=0, stop=None):
+    batch = {}
+    for column in columns:
+        if column in meta['columns']:
+            values, dictionary = read_column(cachedir, meta, column)
+            batch[column] = (numpy.asarray(values[start:stop]), dictionary)
+    return batch
+
+def _records_batch(records, columns):
+    batch = {}
+    if not records:
+        return batch
+    for column in columns:
+        if column not in records[0]:
+            continue
+        if column in TYPED_COLUMNS:
+            typecode = TYPED_COLUMNS[column][1]
+            values = numpy.fromiter((record[column] for record in records), dtype=typecode, count=len(records))
+            batch[column] = (values, None)
+        else:
+            code = {}
+            values = numpy.fromiter((code.setdefault(record[column], len(code)) for record in records), dtype=STRING_TYPECODE, count=len(records))
+            batch[column] = (values, list(code))
+    return batch
+
+def convert(filepath, cachedir):
+    """convert writes a Cost and Usage Report CSV file into a columnar cache
+    directory. Typed columns are stored as arrays of their native type, other
+    columns as arrays of codes into a per-column dictionary."""
+    tmpdir = cachedir + '.tmp'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+    with open(filepath) as f:
+        reader = csv.reader(f)
+        try:
+            header = next(reader)
+        except StopIteration:
+            header = []
+        parsers = []
+        typecodes = []
+        for column in header:
+            parse, typecode = TYPED_COLUMNS.get(column, (None, STRING_TYPECODE))
+            parsers.append(parse)
+            typecodes.append(typecode)
+        codes = [{} for _ in header]
+        chunks = [array.array(typecode) for typecode in typecodes]
+        outfiles = [open(os.path.join(tmpdir, '{}.bin'.format(i)), 'wb') for i in range(len(header))]
+        rows = 0
+        try:
+            for row in reader:
+                if len(row) < len(header):
+                    row += [''] * (len(header) - len(row))
+                for value, parse, code, chunk in zip(row, parsers, codes, chunks):
+                    if parse is not None:
+                        chunk.append(parse(value))
+                    else:
+                        chunk.append(code.setdefault(value, len(code)))
+                rows += 1
+                if rows % CACHE_CHUNK_ROWS == 0:
+                    for chunk, outfile in zip(chunks, outfiles):
+                        chunk.tofile(outfile)
+                        del chunk[:]
+            for chunk, outfile in zip(chunks, outfiles):
+                chunk.tofile(outfile)
+        finally:
+            for outfile in outfiles:
+                outfile.close()
+    for i, code in enumerate(codes):
+        if typecodes[i] == STRING_TYPECODE:
+            with open(os.path.join(tmpdir, '{}.json'.format(i)), 'w') as f:
+                json.dump(list(code), f)
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': CACHE_VERSION,
+            'source': _cache_source(filepath),
+            'rows': rows,
+            'columns': header,
+            'typecodes': typecodes,
+        }, f)
+    shutil.rmtree(cachedir, ignore_errors=True)
+    os.rename(tmpdir, cachedir)
+
+def _csv_filenames(dirpath):
+    return sorted(
+        filename
+        for filename in os.listdir(dirpath)
+        if filename.endswith('.csv')
+    )
+
+def cache_file(filepath, cachepath=DIR_USAGECOST_CACHE):
+    """cache_file converts a CSV file unless its cache is up to date. The cache
+    is named after the file, so that it is found for any link to the file
+    under the same name."""
+    os.makedirs(cachepath, exist_ok=True)
+    filename = os.path.basename(filepath)
+    cachedir = _cache_path(filename, cachepath)
+    if _cache_meta(filepath, cachedir) is None:
+        print("Caching {}...".format(filename))
+        convert(filepath, cachedir)
+
+def build_cache(dirpath=DIR_USAGECOST, cachepath=DIR_USAGECOST_CACHE):
+    """build_cache converts every CSV file in dirpath whose cache is missing or
+    stale, and removes the caches of files which no longer exist."""
+    os.makedirs(cachepath, exist_ok=True)
+    filenames = _csv_filenames(dirpath)
+    for filename in filenames:
+        cache_file(os.path.join(dirpath, filename), cachepath)
+    for filename in set(os.listdir(cachepath)) - set(filenames):
+        shutil.rmtree(os.path.join(cachepath, filename), ignore_errors=True)
+
+def _scan_tasks(dirpath, cachepath):
+    """_scan_tasks splits the line items in dirpath in independent chunks: a
+    range of rows of a cached file, or a whole CSV file."""
+    for filename in _csv_filenames(dirpath):
+        filepath = os.path.join(dirpath, filename)
+        cachedir = _cache_path(filename, cachepath)
+        meta = _cache_meta(filepath, cachedir)
+        if meta is None:
+            yield (filepath, None, None, 0, None)
+        else:
+            for start in range(0, meta['rows'], SCAN_CHUNK_ROWS):
+                yield (filepath, cachedir, meta, start, start + SCAN_CHUNK_ROWS)
+
+def _task_records(task, columns):
+    filepath, cachedir, meta, start, stop = task
+    if meta is None:
+        return _csv_records(filepath, columns)
+    return _cached_records(cachedir, meta, columns, start, stop)
+
+def records(columns, dirpath=DIR_USAGECOST, cachepath=DIR_USAGECOST_CACHE):
+    """records yields every line item in dirpath, read from the columnar cache
+    where it is up to date and from the CSV file otherwise, as records holding
+    only the requested columns."""
+    for task in _scan_tasks(dirpath, cachepath):
+        yield from _task_records(task, columns)
+
+def _columns(aggregators):
+    return sorted(set(
+        column
+        for aggregator in aggregators
+        for column in aggregator.columns
+    ))
+
+def _is_batch_aggregator(aggregator):
+    return hasattr(aggregator, 'add_batch')
+
+def _feed(aggregators, task):
+    filepath, cachedir, meta, start, stop = task
+    adds = [aggregator.add for aggregator in aggregators if not _is_batch_aggregator(aggregator)]
+    add_batches = [aggregator.add_batch for aggregator in aggregators if _is_batch_aggregator(aggregator)]
+    row_columns = _columns(aggregator for aggregator in aggregators if not _is_batch_aggregator(aggregator))
+    batch_columns = _columns(aggregator for aggregator in aggregators if _is_batch_aggregator(aggregator))
+    if meta is not None:
+        if adds:
+            for record in _cached_records(cachedir, meta, row_columns, start, stop):
+                for add in adds:
+                    add(record)
+        if add_batches:
+            batch = _cached_batch(cachedir, meta, batch_columns, start, stop)
+            for add_batch in add_batches:
+                add_batch(batch)
+        return aggregators
+    # An uncached file is parsed once for both kinds of aggregators, its
+    # records being gathered in batches for the batch aggregators.
+    pending = []
+    for record in _csv_records(filepath, _columns(aggregators)):
+        for add in adds:
+            add(record)
+        if add_batches:
+            pending.append(record)
+            if len(pending) == BATCH_ROWS:
+                batch = _records_batch(pending, batch_columns)
+                for add_batch in add_batches:
+                    add_batch(batch)
+                pending = []
+    if pending:
+        batch = _records_batch(pending, batch_columns)
+        for add_batch in add_batches:
+            add_batch(batch)
+    return aggregators
+
+def _scan_task(aggregator_types, task):
+    aggregators = [aggregator_type() for aggregator_type in aggregator_types]
+    return _feed(aggregators, task)
+
+def scan(aggregators, dirpath=DIR_USAGECOST, cachepath=DIR_USAGECOST_CACHE, jobs=1):
+    """scan reads every line item of the Cost and Usage Report files in
+    dirpath once and feeds it to each of the aggregators. An aggregator is any
+    object with a list of the columns it reads and an add(record) method.
+
+    Aggregators with an add_batch(batch) method instead receive the line items
+    in batches of columns: a dict mapping each column to a pair of a numpy
+    array of values and, for string columns, the list of strings the values
+    are codes into, or None.
+
+    With more than one job, chunks of line items are fed to fresh aggregators
+    of the same types in worker processes, and the partial aggregators are
+    then merged into the given ones with their merge(other) method."""
+    if jobs <= 1:
+        for task in _scan_tasks(dirpath, cachepath):
+            _feed(aggregators, task)
+        return aggregators
+    aggregator_types = [type(aggregator) for aggregator in aggregators]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        partials = pool.map(
+            functools.partial(_scan_task, aggregator_types),
+            _scan_tasks(dirpath, cachepath),
+        )
+        for partial in partials:
+            for aggregator, other in zip(aggregators, partial):
+                aggregator.merge(other)
+    return aggregators
+
+def run(aggregators, dirpath=DIR_USAGECOST, cachepath=DIR_USAGECOST_CACHE, jobs=1):
+    """run scans the line items once for all the aggregators, then has each of
+    them write its output."""
+    for aggregator in scan(aggregators, dirpath, cachepath, jobs):
+        aggregator.write()
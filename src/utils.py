@@ -1,4 +1,5 @@
 import csv
+import operator
 import os
 
 def rows_folder(dirpath):
@@ -13,10 +14,59 @@ def rows(csvfile):
     for row in reader:
         yield row
 
+class Record:
+    """Record holds the projected fields of a CSV row. Fields are accessed by
+    column name as with a dict, through an index shared by all the records of
+    a file. Columns absent from the file are absent from the record."""
+    __slots__ = ('_values', '_index')
+
+    def __init__(self, values, index):
+        self._values = values
+        self._index = index
+
+    def __getitem__(self, column):
+        return self._values[self._index[column]]
+
+    def __contains__(self, column):
+        return column in self._index
+
+    def get(self, column, default=None):
+        i = self._index.get(column)
+        return default if i is None else self._values[i]
+
+def projected_rows(csvfile, columns, parsers={}):
+    """projected_rows yields a Record with only the requested columns for each
+    row of csvfile, with the values of the columns in parsers parsed by the
+    matching function. The header is resolved once for the whole file."""
+    reader = csv.reader(csvfile)
+    header = next(reader, [])
+    positions = {column: i for i, column in enumerate(header)}
+    present = [column for column in columns if column in positions]
+    index = {column: i for i, column in enumerate(present)}
+    typed = [(index[column], parsers[column]) for column in present if column in parsers]
+    if len(present) > 1:
+        getter = operator.itemgetter(*(positions[column] for column in present))
+    elif len(present) == 1:
+        position = positions[present[0]]
+        getter = lambda row: (row[position],)
+    else:
+        getter = lambda row: ()
+    for row in reader:
+        if len(row) < len(header):
+            row += [''] * (len(header) - len(row))
+        values = getter(row)
+        if typed:
+            values = list(values)
+            for i, parse in typed:
+                values[i] = parse(values[i])
+        yield Record(values, index)
+
 class csv_folder:
     """csv_folder is to be used in conjunction with the 'with' statement. It is
-    an iterator over all the CSV records of all files within a folder."""
-    def __init__(self, dirpath, readerclass=csv.DictReader):
+    an iterator over all the CSV records of all files within a folder. If a
+    list of columns is given, the records are projected on them as Record
+    objects instead of being read as dicts by readerclass."""
+    def __init__(self, dirpath, readerclass=csv.DictReader, columns=None):
         self._dirpath = dirpath
         self._filepaths = (
             os.path.join(self._dirpath, filename)
@@ -26,6 +76,7 @@ class csv_folder:
         self._reader = None
         self._handle = None
         self._readerclass = readerclass
+        self._columns = columns
 
     def __enter__(self):
         return self
@@ -48,7 +99,10 @@ class csv_folder:
     def _open_next(self):
         filepath = next(self._filepaths)
         self._handle = open(filepath, 'rt')
-        self._reader = self._readerclass(self._handle)
+        if self._columns is not None:
+            self._reader = projected_rows(self._handle, self._columns)
+        else:
+            self._reader = self._readerclass(self._handle)
 
     def _close(self):
         if self._handle is not None:
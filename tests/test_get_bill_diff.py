@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import get_bill_diff
+import usagecost
+
+REPORT_WITHOUT_PRODUCT_CODE = """\
+lineItem/UsageStartDate,lineItem/UsageType,lineItem/UnblendedCost
+2018-01-02T00:00:00Z,BoxUsage:t2.micro,1.5
+2018-01-03T00:00:00Z,BoxUsage:t2.micro,2.0
+2018-02-01T00:00:00Z,TimedStorage-ByteHrs,0.25
+"""
+
+EXPECTED_BREAKDOWN = {
+    (2018 * 12, 'BoxUsage:t2.micro'): 3.5,
+    (2018 * 12 + 1, 'TimedStorage-ByteHrs'): 0.25,
+}
+
+
+class TestMissingProductCode(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dirpath = os.path.join(self.tmpdir.name, 'usagecost')
+        self.cachepath = os.path.join(self.tmpdir.name, 'cache')
+        os.makedirs(self.dirpath)
+        with open(os.path.join(self.dirpath, 'report.csv'), 'w') as f:
+            f.write(REPORT_WITHOUT_PRODUCT_CODE)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def breakdown(self, engine):
+        aggregator = get_bill_diff.ENGINES[engine]()
+        usagecost.scan([aggregator], self.dirpath, self.cachepath)
+        return dict(aggregator.breakdown)
+
+    def test_engines_from_csv(self):
+        for engine in get_bill_diff.ENGINES:
+            with self.subTest(engine=engine):
+                self.assertEqual(self.breakdown(engine), EXPECTED_BREAKDOWN)
+
+    def test_engines_from_cache(self):
+        usagecost.build_cache(self.dirpath, self.cachepath)
+        for engine in get_bill_diff.ENGINES:
+            with self.subTest(engine=engine):
+                self.assertEqual(self.breakdown(engine), EXPECTED_BREAKDOWN)
+
+
+if __name__ == '__main__':
+    unittest.main()
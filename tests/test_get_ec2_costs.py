@@ -0,0 +1,97 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import get_ec2_costs
+import pricing
+
+FIXTURE_OFFER = os.path.join(os.path.dirname(__file__), 'fixtures', 'ec2_offer.json')
+CHUNK_SIZES = (1, 2, 3, 7, 64, 1 << 20)
+
+
+def expected_rows(offer):
+    ondemand = offer['terms']['OnDemand']
+    return [
+        pricing.price_row(pricing.price_attributes(product['attributes']), get_ec2_costs.ondemand_cost(ondemand[sku]))
+        for sku, product in offer['products'].items()
+        if product['productFamily'] == get_ec2_costs.PRODUCT_FAMILY and sku in ondemand
+    ]
+
+
+class TestReadOffer(unittest.TestCase):
+
+    def setUp(self):
+        with open(FIXTURE_OFFER, encoding='utf-8') as f:
+            self.text = f.read()
+        self.offer = json.loads(self.text)
+
+    def test_json_stream_decodes_like_json_load(self):
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                stream = get_ec2_costs.JsonStream(io.StringIO(self.text), chunk_size)
+                self.assertEqual(stream.value(), self.offer)
+
+    def test_json_stream_members(self):
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                stream = get_ec2_costs.JsonStream(io.StringIO(self.text), chunk_size)
+                decoded = {}
+                for key in stream.members():
+                    decoded[key] = stream.value()
+                self.assertEqual(decoded, self.offer)
+
+    def test_read_offer(self):
+        expected = expected_rows(self.offer)
+        self.assertEqual(len(expected), 4)
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                publication_date, rows = get_ec2_costs.read_offer(io.StringIO(self.text), chunk_size=chunk_size)
+                self.assertEqual(publication_date, self.offer['publicationDate'])
+                self.assertEqual(rows, expected)
+
+    def test_read_offer_unchanged(self):
+        publication_date, rows = get_ec2_costs.read_offer(io.StringIO(self.text), self.offer['publicationDate'], chunk_size=3)
+        self.assertEqual(publication_date, self.offer['publicationDate'])
+        self.assertIsNone(rows)
+
+
+class TestUpdateCache(unittest.TestCase):
+
+    def test_global_offer_split_by_region(self):
+        with tempfile.TemporaryDirectory() as cachedir:
+            get_ec2_costs.update_cache([(FIXTURE_OFFER, None)], cachedir)
+            manifest = pricing.read_manifest(cachedir)
+            self.assertEqual(sorted(manifest['regions']), ['eu-north-1', 'eu-west-3', 'us-east-1'])
+            self.assertEqual(
+                sorted(f for f in os.listdir(cachedir) if f != 'manifest.json'),
+                ['eu-north-1.json', 'eu-west-3.json', 'us-east-1.json'],
+            )
+            prices = pricing.PriceIndex(cachedir)
+            self.assertEqual(prices.ondemand_cost('eu-north-1', 'm5.large', 'Dedicated', 'Windows'), 0.214)
+            self.assertEqual(prices.ondemand_cost('eu-west-3', 'c5.xlarge', 'Shared', 'RHEL'), 0.264)
+            self.assertEqual(prices.ondemand_cost('us-east-1', 't2.micro', 'Shared', 'Linux'), 0.0116)
+            self.assertIsNone(prices.ondemand_cost('us-east-1', 't2.small', 'Shared', 'Linux'))
+
+    def test_regional_offer(self):
+        with tempfile.TemporaryDirectory() as cachedir:
+            get_ec2_costs.update_cache([(FIXTURE_OFFER, 'eu-north-1')], cachedir)
+            prices = pricing.PriceIndex(cachedir)
+            self.assertEqual(prices.ondemand_cost('eu-north-1', 'm5.large', 'Dedicated', 'Windows'), 0.214)
+
+
+class TestManifest(unittest.TestCase):
+
+    def test_corrupt_manifest_reads_as_empty(self):
+        with tempfile.TemporaryDirectory() as cachedir:
+            with open(os.path.join(cachedir, 'manifest.json'), 'w') as f:
+                f.write('{"version": 1, "regions": {"us-ea')
+            self.assertEqual(pricing.read_manifest(cachedir), {'version': pricing.MANIFEST_VERSION, 'regions': {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
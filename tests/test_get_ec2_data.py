@@ -0,0 +1,96 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import get_ec2_data
+
+KEY = ('m5.large', 'default', 'Linux/UNIX')
+OTHER_KEY = ('t2.micro', 'default', 'Linux/UNIX')
+
+
+class TestOfferingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'eu-west-1.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def cache(self, ttl=get_ec2_data.OFFERINGS_TTL):
+        return get_ec2_data.OfferingCache('eu-west-1', self.tmpdir.name, ttl)
+
+    def test_corrupt_cache_starts_empty(self):
+        for content in ('[[1, 2', '42', '[[1, 2]]'):
+            with self.subTest(content=content):
+                with open(self.path, 'w') as f:
+                    f.write(content)
+                self.assertEqual(self.cache().entries, {})
+
+    def test_persisted_costs(self):
+        cache = self.cache()
+        self.assertEqual(cache.get(KEY, lambda: [0.05, 0.07]), [0.05, 0.07])
+        cache.save()
+        self.assertEqual(self.cache().get(KEY, self.fail), [0.05, 0.07])
+
+    def test_save_drops_expired_entries(self):
+        with open(self.path, 'w') as f:
+            json.dump([
+                [*KEY, time.time() - 2 * 3600, [0.05, 0.07]],
+                [*OTHER_KEY, time.time(), None],
+            ], f)
+        self.cache(ttl=3600).save()
+        with open(self.path) as f:
+            self.assertEqual([row[:3] for row in json.load(f)], [list(OTHER_KEY)])
+
+    def test_failed_fetch_skips_key(self):
+        calls = []
+
+        def fetch():
+            calls.append(None)
+            raise RuntimeError('throttled')
+
+        cache = self.cache()
+        self.assertIsNone(cache.get(KEY, fetch))
+        self.assertIsNone(cache.get(KEY, fetch))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.get(OTHER_KEY, lambda: [0.01, 0.02]), [0.01, 0.02])
+        cache.save()
+        self.assertNotIn(KEY, self.cache().entries)
+
+    def test_waiters_share_failure(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(None)
+            started.set()
+            release.wait()
+            raise RuntimeError('throttled')
+
+        cache = self.cache()
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get(KEY, fetch)))
+            for _ in range(4)
+        ]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [None] * 4)
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
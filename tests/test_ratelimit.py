@@ -0,0 +1,179 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+import botocore.exceptions
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import ratelimit
+
+
+def client_error(code):
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': code}}, 'DescribeThings')
+
+
+class FakeClock:
+    """FakeClock stands for the time module in ratelimit: sleeping advances
+    the clock instantly and is recorded."""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeClient:
+    """FakeClient answers describe_things with the page of its NextToken,
+    after raising errors with the given codes on its first calls."""
+    def __init__(self, pages, errors=()):
+        self.pages = pages
+        self.errors = list(errors)
+        self.calls = []
+
+    def describe_things(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.errors:
+            raise client_error(self.errors.pop(0))
+        return self.pages[kwargs.get('NextToken')]
+
+
+ONE_PAGE = {None: {'Things': [1, 2]}}
+
+PAGES = {
+    None: {'Things': [1, 2], 'NextToken': 'a'},
+    'a': {'Things': [3], 'NextToken': 'b'},
+    'b': {'Things': [4, 5]},
+}
+
+
+class ClockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(ratelimit, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def throttle(self, **kwargs):
+        return ratelimit.Throttle(
+            'test',
+            bucket=ratelimit.TokenBucket(rate=1000.0, burst=1000),
+            concurrency=ratelimit.AdaptiveConcurrency(initial=8),
+            **kwargs
+        )
+
+
+class TestTokenBucket(ClockTestCase):
+
+    def test_burst_then_rate(self):
+        bucket = ratelimit.TokenBucket(rate=2.0, burst=3)
+        for _ in range(3):
+            bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [])
+        bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [0.5])
+        bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [0.5, 0.5])
+
+    def test_refill_capped_at_burst(self):
+        bucket = ratelimit.TokenBucket(rate=2.0, burst=3)
+        self.clock.now += 60
+        for _ in range(3):
+            bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [])
+        bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [0.5])
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+
+    def test_throttled_halves_limit(self):
+        concurrency = ratelimit.AdaptiveConcurrency(initial=8)
+        limits = []
+        for _ in range(5):
+            concurrency.throttled()
+            limits.append(concurrency.limit)
+        self.assertEqual(limits, [4, 2, 1, 1, 1])
+
+    def test_successes_grow_limit(self):
+        concurrency = ratelimit.AdaptiveConcurrency(initial=2, maximum=3)
+        concurrency.succeeded()
+        self.assertEqual(concurrency.limit, 2)
+        concurrency.succeeded()
+        self.assertEqual(concurrency.limit, 3)
+        for _ in range(6):
+            concurrency.succeeded()
+        self.assertEqual(concurrency.limit, 3)
+
+
+class TestThrottle(ClockTestCase):
+
+    def test_retries_throttled_calls(self):
+        client = FakeClient(ONE_PAGE, errors=['Throttling'] * 3)
+        throttle = self.throttle()
+        self.assertEqual(throttle.call(client.describe_things), ONE_PAGE[None])
+        self.assertEqual(len(client.calls), 4)
+        # halved from 8 down to 1, then grown again by the final success
+        self.assertEqual(throttle.concurrency.limit, 2)
+        self.assertEqual(len(self.clock.sleeps), 3)
+        for attempt, delay in enumerate(self.clock.sleeps):
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(ratelimit.BACKOFF_CAP, ratelimit.BACKOFF_BASE * 2 ** attempt))
+
+    def test_gives_up_after_max_attempts(self):
+        client = FakeClient(ONE_PAGE, errors=['Throttling'] * ratelimit.MAX_ATTEMPTS)
+        with self.assertRaises(botocore.exceptions.ClientError):
+            self.throttle().call(client.describe_things)
+        self.assertEqual(len(client.calls), ratelimit.MAX_ATTEMPTS)
+        self.assertEqual(len(self.clock.sleeps), ratelimit.MAX_ATTEMPTS - 1)
+
+    def test_backoff_capped(self):
+        client = FakeClient(ONE_PAGE, errors=['RequestLimitExceeded'] * 12)
+        with mock.patch.object(ratelimit.random, 'uniform', lambda low, high: high):
+            with self.assertRaises(botocore.exceptions.ClientError):
+                self.throttle(attempts=12).call(client.describe_things)
+        self.assertEqual(self.clock.sleeps[0], ratelimit.BACKOFF_BASE)
+        self.assertEqual(max(self.clock.sleeps), ratelimit.BACKOFF_CAP)
+
+    def test_other_errors_not_retried(self):
+        client = FakeClient(ONE_PAGE, errors=['AccessDenied'])
+        throttle = self.throttle()
+        with self.assertRaises(botocore.exceptions.ClientError):
+            throttle.call(client.describe_things)
+        self.assertEqual(len(client.calls), 1)
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(throttle.concurrency.limit, 8)
+
+
+class TestClient(ClockTestCase):
+
+    def test_paginate_follows_next_token(self):
+        client = FakeClient(PAGES, errors=['Throttling'])
+        pages = list(ratelimit.Client(client, self.throttle()).paginate('describe_things', MaxResults=2))
+        self.assertEqual(pages, [PAGES[None], PAGES['a'], PAGES['b']])
+        self.assertEqual(client.calls, [
+            {'MaxResults': 2},
+            {'MaxResults': 2},
+            {'MaxResults': 2, 'NextToken': 'a'},
+            {'MaxResults': 2, 'NextToken': 'b'},
+        ])
+
+    def test_client_disables_botocore_retries(self):
+        session = mock.Mock(region_name='eu-west-1')
+        wrapped = ratelimit.client(session, 'test-ratelimit')
+        session.client.assert_called_once_with(
+            'test-ratelimit', region_name='eu-west-1', config=ratelimit.CLIENT_CONFIG)
+        self.assertEqual(ratelimit.CLIENT_CONFIG.retries, {'max_attempts': 0})
+        self.assertIs(wrapped.throttle, ratelimit.region_throttle('test-ratelimit', 'eu-west-1'))
+
+
+if __name__ == '__main__':
+    unittest.main()